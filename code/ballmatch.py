@@ -12,6 +12,7 @@ Jonas Toft Arnfred, 2013-08-28
 
 import features
 import numpy
+from matchresult import MatchResult
 from sklearn.neighbors.ball_tree import BallTree
 
 
@@ -51,14 +52,9 @@ def match_speed(paths, options = {}) :
     # Get matches
     match_data = list(getMatches(bt, ns, indices, ks, ds, dist_threshold))
 
-    def match_fun(ratio_threshold) :
-        matches = [(pos, s, u) for pos, s, u in match_data if u < ratio_threshold]
-        if len(matches) == 0 :
-            return [], [], []
-        else :
-            return zip(*matches)
-
-    return lambda t : match_fun(t)
+    if len(match_data) == 0 : return MatchResult([[], [], []], [])
+    columns = zip(*match_data)
+    return MatchResult(columns, columns[2])
 
 
 def match_radius(paths, options = {}) :
@@ -92,14 +88,9 @@ def match_radius(paths, options = {}) :
     # Get matches
     match_data = list(query_all())
 
-    def match_fun(ratio_threshold) :
-        matches = [(pos, s, u, g) for pos, s, u, g in match_data if u < ratio_threshold]
-        if len(matches) == 0 :
-            return [], [], [], []
-        else :
-            return zip(*matches)
-
-    return lambda t : match_fun(t)
+    if len(match_data) == 0 : return MatchResult([[], [], [], []], [])
+    columns = zip(*match_data)
+    return MatchResult(columns, columns[2])
 
 def query_unique(tree, i, descriptor, indices, ks, ratio_boost = 1) : 
     #print("."),
@@ -11,10 +11,12 @@ Jonas Toft Arnfred, 2013-05-22
 ####################################
 
 import numpy
+import scipy.sparse
 import features
 import louvain
 import weightMatrix
 import scoring
+from matchresult import MatchResult
 from itertools import combinations
 
 
@@ -28,38 +30,53 @@ from itertools import combinations
 def match(paths, options = {}) :
 
     # Get parameters
-    prune_fun = options.get("prune_fun", weightMatrix.pruneThreshold)
-    prune_limit = options.get("prune_limit", 2.5)
-    keypoint_type = options.get("keypoint_type", "SIFT")
-    descriptor_type = options.get("descriptor_type", "SIFT")
     verbose = options.get("verbose", False)
     split_limit = options.get("split_limit", 50)
     cluster_prune_limit = options.get("cluster_prune_limit", 1.5)
 
     # Get all feature points
     indices, ks, ds = features.getFeatures(paths, options)
-
-    # Calculate weight matrix
-    weights = weightMatrix.init(ds, descriptor_type)
+    positions = numpy.array(features.getPositions(ks))
 
     # Get cluster weights
-    cluster_weights = prune_fun(weights, prune_limit)
+    weights, cluster_weights, top_weights = getClusterWeights(ds, options)
 
     # Cluster graph
     partitions = cluster(cluster_weights, indices, split_limit = split_limit, prune_limit = cluster_prune_limit, verbose=verbose)
     if verbose : print("%i partitions" % len(set(partitions)))
 
-    def match_fun(threshold) :
-        match_data = list(getPartitionMatches(partitions, cluster_weights, weights, indices, threshold))
-        if len(match_data) == 0 : return [], [], []
-        match_ind, ratios, scores = zip(*match_data)
+    # Collect all matches once along with the lowest threshold that lets each through
+    match_data = list(getPartitionMatches(partitions, cluster_weights, weights, indices, numpy.inf, with_keys = True, top_weights = top_weights))
+    if len(match_data) == 0 : return MatchResult([[], [], []], [])
+    match_ind, ratios, scores, keys = zip(*match_data)
+
+    # Get positions
+    matches = positions[numpy.array(match_ind)]
+
+    return MatchResult([matches, ratios, scores], keys)
+
+
+def getClusterWeights(ds, options = {}) :
+    """ Returns (weights, cluster_weights, top_weights). With sparse_weights
+        (default when pruning with weightMatrix.pruneThreshold) the pruned
+        cluster weights are computed block by block with weightMatrix.initPruned,
+        so weights is None and top_weights holds the two largest weights of
+        every row. Otherwise the dense weights are pruned with prune_fun
+    """
+    prune_fun = options.get("prune_fun", weightMatrix.pruneThreshold)
+    prune_limit = options.get("prune_limit", 2.5)
+    descriptor_type = options.get("descriptor_type", "SIFT")
+    weight_dtype = options.get("weight_dtype", numpy.float64)
+    weight_block_size = options.get("weight_block_size", None)
+    sparse_weights = options.get("sparse_weights", prune_fun == weightMatrix.pruneThreshold)
 
-        # Get positions
-        matches = [getMatchPosition(m_i, m_j, ks) for (m_i, m_j) in match_ind]
+    if sparse_weights :
+        cluster_weights, top_weights = weightMatrix.initPruned(ds, descriptor_type, prune_limit, block_size = weight_block_size or 1000, dtype = weight_dtype, with_top = True)
+        return None, cluster_weights, top_weights
 
-        return matches, ratios, scores
+    weights = weightMatrix.init(ds, descriptor_type, dtype = weight_dtype, block_size = weight_block_size)
+    return weights, prune_fun(weights, prune_limit), None
 
-    return lambda t : match_fun(t)
 
 
 def getMatchSet(paths, options = {}) :
@@ -94,103 +111,166 @@ def getMatches(m, ind, threshold) :
 
 
 def cluster(weights, indices, split_limit = 10, prune_limit = 3, verbose = False, rec_level = 0) :
+    """ Clusters the graph with louvain and splits every partition larger than
+        split_limit by clustering its pruned and normalized subgraph again.
+        Every partition is handled as a sorted array of the vertex indices in
+        it, so only the submatrix of the partition is copied (weights can be
+        a dense or a scipy.sparse matrix)
+    """
     partitions = louvain.cluster(weights, verbose=verbose)
     if rec_level > 10 : return partitions
-    p_set = set(partitions)
-    
-    r = numpy.arange(0, weights.shape[0])
-    for p in p_set :
-        partition_mask = partitions == p
-        for i,j in combinations(set(indices),2) :
-            # Set up masks
-            row_mask = partition_mask & (indices == i)
-            col_mask = partition_mask & (indices == j)
-            index_row = r[row_mask]
-            index_col = r[col_mask]
-    
-            # Get weights
-            pij_edges = weights[row_mask][:,col_mask]
-            p_edges = weights[partition_mask][:,partition_mask]
-            nb_inter_edges = numpy.sum(pij_edges > 0)
-            if (numpy.sum(partition_mask) > split_limit) :
-                # Prune weights
-                p_edges_pruned = weightMatrix.pruneThreshold(p_edges, prune_limit)
-
-                # If there are no edges left, then skip
-                if numpy.sum(p_edges_pruned) == 0 : continue
-
-                # normalizing weights
-                p_max = numpy.max(p_edges_pruned)
-                p_min = numpy.min(p_edges_pruned[p_edges_pruned.nonzero()])
-                p_zero = p_edges_pruned == 0
-                p_edges_norm = (p_edges_pruned - p_min) / (p_max - p_min)
-                p_edges_norm[p_zero] = 0
-                
-                # cluster
-                p_partition = cluster(p_edges_norm, indices[partition_mask], split_limit, prune_limit, verbose, rec_level + 1)
-            
-                # Update partitioning
-                partitions[partition_mask] = p_partition + numpy.max(partitions) + 1
+
+    # Partitions are only split when there are features from several images
+    nb_pairs = len(list(combinations(set(indices), 2)))
+    if nb_pairs == 0 : return partitions
+
+    # Sort the vertices by partition so every partition is a range of order
+    order = numpy.argsort(partitions, kind="mergesort")
+    labels, starts = numpy.unique(partitions[order], return_index = True)
+    ends = numpy.append(starts[1:], len(order))
+
+    for start, end in zip(starts, ends) :
+        members = order[start:end]
+        if len(members) <= split_limit : continue
+
+        # Prune weights
+        p_edges = submatrix(weights, members)
+        p_edges_pruned = weightMatrix.pruneThreshold(p_edges, prune_limit)
+
+        # If there are no edges left, then skip
+        if numpy.sum(p_edges_pruned) == 0 : continue
+
+        # normalizing weights
+        p_max = numpy.max(p_edges_pruned)
+        p_min = numpy.min(p_edges_pruned[p_edges_pruned.nonzero()])
+        p_zero = p_edges_pruned == 0
+        p_edges_norm = (p_edges_pruned - p_min) / (p_max - p_min)
+        p_edges_norm[p_zero] = 0
+
+        # cluster
+        p_partition = cluster(p_edges_norm, indices[members], split_limit, prune_limit, verbose, rec_level + 1)
+
+        # Give the new partitions labels above all existing ones
+        partitions[members] = p_partition + numpy.max(partitions) + 1
     return partitions
 
 
-def getPartitionMatches(partitions, weights, full_weights, indices, threshold, verbose = False, ks = None, homography = None) :
-
-    # index
-    index = numpy.arange(0, weights.shape[0])
-    # Get numpy array of indices
-    for p in set(partitions) :
-
-        partition_mask = partitions == p
-        partition_weights = weights[partition_mask][:, partition_mask]
-        for i,j in combinations(set(indices),2) :
-
-            # Set up masks
-            mask_row = partition_mask & (indices == i)
-            mask_col = partition_mask & (indices == j)
-            mask_both = mask_row | mask_col
-            index_row = index[mask_row]
-            index_col = index[mask_col]
-            index_both = index[mask_row | mask_col]
-
-            # Get weights
-            pij_edges = weights[mask_row][:,mask_col]
-            pij_edges_both = weights[mask_both][:,mask_both]
-            nb_e = numpy.sum(pij_edges > 0)
-
-            # If the cluster as only one edge going from one image to the other
-            if nb_e == 1 :
-                # Get weight
-                (m_i, m_j) = numpy.unravel_index(pij_edges.argmax(), pij_edges.shape)
-                w = pij_edges[m_i, m_j]
-                
-                # Get second largest row and col weight
-                sort_row = numpy.sort(full_weights[index_row[m_i],:])
-                sort_col = numpy.sort(full_weights[:,index_col[m_j]])
-                
-                # Test if the maximum match is the both for row and col
-                bothways_p = sort_row[-1] == sort_col[-1]
-                ratio_row = sort_row[-2] / w
-                ratio_col = sort_col[-2] / w
-
-                if bothways_p and (ratio_row < threshold and ratio_col < threshold) :
-                    (p_i, p_j) = (index_row[m_i], index_col[m_j])
-                    if verbose : 
-                        distance = matchDistance(ks[p_i].pt, ks[p_j].pt, homography)
-                        print("%4i\tEdges: %i\tDistance: %.2f" % (p, nb_e, distance))
-                    yield ((p_i, p_j), ratio_row, w)
-
-            # If there are several edges
-            elif nb_e >= 2 :
-
-                # Collect matches and check if they are beyond threshold
-                matches, ratios, scores = getMatches(pij_edges_both, indices[mask_both], threshold)
-                for (m_i,m),u,s in zip(matches, ratios, scores) :
-                    (p_i, p_j) = (index_both[m_i], index_both[m])
-                    if verbose :
-                        distance = matchDistance(ks[p_i].pt, ks[p_j].pt, homography)
-                        print("%4i\tEdges: %i\tDistance: %.2f" % (p, nb_e, distance))
-                    yield ((p_i, p_j),u,s)
+
+def submatrix(weights, members, columns = None) :
+    """ Returns the dense submatrix of weights with the rows in members and the
+        columns in columns (members if not given)
+    """
+    if columns is None : columns = members
+    if scipy.sparse.issparse(weights) :
+        return weights.tocsr()[members][:, columns].toarray()
+    return weights[numpy.ix_(members, columns)]
+
+
+
+def getPartitionMatches(partitions, weights, full_weights, indices, threshold, verbose = False, ks = None, homography = None, with_keys = False, top_weights = None) :
+    """ Yields ((p_i, p_j), ratio, score) for every match below threshold. With
+        with_keys the largest ratio tested for the match is appended, so that the
+        match is found for any threshold above it. Works on the edges of the
+        graph within each partition instead of looping over partitions, and
+        yields the same matches in the same order as the loop it replaces (see
+        test_clustermatch) for non-negative weights (rows with several equal
+        maxima aside).
+        weights can be a dense or a scipy.sparse matrix. Instead of the dense
+        full_weights, top_weights can be the second largest and largest weight
+        of every row as returned by weightMatrix.initPruned(..., with_top = True)
+    """
+    nb_vertices = weights.shape[0]
+
+    # Second largest and largest weight of a row or column of the full weights
+    if top_weights is not None :
+        top_row = top_col = lambda m : top_weights[m]
+    else :
+        full_weights = numpy.asarray(full_weights)
+        top_row = lambda m : numpy.partition(full_weights[m], [-2, -1], axis = 1)[:, -2:]
+        top_col = lambda m : numpy.partition(full_weights[:, m].T, [-2, -1], axis = 1)[:, -2:]
+
+    # Partitions are visited in the order of set(partitions)
+    p_order = numpy.array(list(set(partitions)))
+    p_labels = numpy.sort(p_order)
+    p_rank = numpy.zeros(len(p_labels), dtype=numpy.int64)
+    p_rank[numpy.searchsorted(p_labels, p_order)] = numpy.arange(len(p_order))
+    p_index = numpy.searchsorted(p_labels, partitions)
+
+    # Collect the edges within partitions
+    if scipy.sparse.issparse(weights) :
+        edges = weights.tocsr()
+        edges.sort_indices()
+        edges = edges.tocoo()
+        nonzero = edges.data != 0
+        rows, cols, values = edges.row[nonzero], edges.col[nonzero], edges.data[nonzero]
+    else :
+        weights = numpy.asarray(weights)
+        rows, cols = weights.nonzero()
+        values = weights[rows, cols]
+    same = p_index[rows] == p_index[cols]
+    rows, cols, values = rows[same], cols[same], values[same]
+
+    found = []
+    for pair_rank, (i, j) in enumerate(combinations(set(indices), 2)) :
+
+        # Number of edges from image i to image j in every partition
+        in_pair = numpy.in1d(indices[rows], [i, j]) & numpy.in1d(indices[cols], [i, j])
+        cross = in_pair & (indices[rows] == i) & (indices[cols] == j) & (values > 0)
+        nb_e = numpy.bincount(p_index[rows[cross]], minlength = len(p_labels))
+
+        # Partitions with only one edge from one image to the other
+        single = cross & (nb_e[p_index[rows]] == 1)
+        if single.any() :
+            m_i, m_j, w = rows[single], cols[single], values[single]
+
+            # Get largest and second largest row and col weight
+            sort_row = top_row(m_i)
+            sort_col = top_col(m_j)
+            bothways_p = sort_row[:, -1] == sort_col[:, -1]
+            ratio_row = sort_row[:, -2] / w
+            ratio_col = sort_col[:, -2] / w
+
+            keep = bothways_p & (ratio_row < threshold) & (ratio_col < threshold)
+            m_i, m_j = m_i[keep], m_j[keep]
+            found.append((p_index[m_i], numpy.ones(len(m_i), dtype=numpy.int64) * pair_rank, m_i, m_j, ratio_row[keep], w[keep], numpy.maximum(ratio_row, ratio_col)[keep], nb_e[p_index[m_i]]))
+
+        # Partitions with several edges
+        several = in_pair & (nb_e[p_index[rows]] >= 2)
+        if several.any() :
+            r, c, v = rows[several], cols[several], values[several]
+
+            # Best and second best weight in every row (ties go to the last column)
+            order = numpy.lexsort((c, v, r))
+            r, c, v = r[order], c[order], v[order]
+            last = numpy.append(r[1:] != r[:-1], True)
+            first = numpy.append(True, r[1:] != r[:-1])
+            best_row, best_col, best_value = r[last], c[last], v[last]
+            second_value = numpy.where(first[last], 0, v[numpy.maximum(numpy.nonzero(last)[0] - 1, 0)])
+            u = second_value / best_value.astype(numpy.float64)
+
+            # Keep rows that are below threshold, and their best match if it is both ways
+            best = -1 * numpy.ones(nb_vertices, dtype=numpy.int64)
+            ratio = numpy.ones(nb_vertices) * numpy.inf
+            below = u < threshold
+            best[best_row[below]] = best_col[below]
+            ratio[best_row] = u
+            mutual = below & (indices[best_row] == 0) & (indices[best_col] != 0)
+            mutual[mutual] = best[best_col[mutual]] == best_row[mutual]
+
+            m_i, m_j = best_row[mutual], best_col[mutual]
+            found.append((p_index[m_i], numpy.ones(len(m_i), dtype=numpy.int64) * pair_rank, m_i, m_j, u[mutual], best_value[mutual], numpy.maximum(u[mutual], ratio[m_j]), nb_e[p_index[m_i]]))
+
+    if len(found) == 0 : return
+    p, pair_rank, m_i, m_j, ratios, scores, keys, edges = map(numpy.concatenate, zip(*found))
+
+    # Yield in the order of the loop
+    for k in numpy.lexsort((m_i, pair_rank, p_rank[p])) :
+        if verbose :
+            distance = matchDistance(features.getPosition(ks[m_i[k]]), features.getPosition(ks[m_j[k]]), homography)
+            print("%4i\tEdges: %i\tDistance: %.2f" % (p_labels[p[k]], edges[k], distance))
+        if with_keys : yield ((m_i[k], m_j[k]), ratios[k], scores[k], keys[k])
+        else : yield ((m_i[k], m_j[k]), ratios[k], scores[k])
+
 
 
 def getCoherence(partition_weights, partition_mask, indices, i, j) :
@@ -210,16 +290,15 @@ def getUniqueness(row) :
 
 
 def getMatchPosition(i,j, keypoints) :
-    pos = features.getPositions([keypoints[i], keypoints[j]])
-    return numpy.array((pos[0], pos[1]))
+    return numpy.array(features.getPositions(keypoints[[i, j]]))
 
 
 
 def getDistMat(keypoints) :
     # Get positions
-    x_list, y_list = zip(*map(features.getPosition, keypoints))
-    x = numpy.array(x_list)
-    y = numpy.array(y_list)
+    positions = numpy.array(features.getPositions(keypoints))
+    x = positions[:,0]
+    y = positions[:,1]
 
     # Calculate distances
     x_outer = numpy.outer(x, x)
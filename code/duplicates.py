@@ -12,10 +12,15 @@ Jonas Toft Arnfred, 2013-05-23
 ####################################
 
 import mirrormatch
+import features
+import vocabulary
+import trees
 import numpy
+import scipy.sparse
 import pylab
 import os
 import math
+import collections
 
 
 ####################################
@@ -35,18 +40,23 @@ def get_files(folder, verbose = False) :
 
 
 
+# Defaults for the matching functions below
+match_defaults = {
+       "leaf_size": 10,
+       "keypoint_type" : "SIFT",
+       "descriptor_type" : "SIFT",
+       "only_mirror" : True,
+       "verbose" : False,
+       "max_kp" : 1000,
+       "feature_type" : 'L',
+}
+
+
+
 def get_matches(paths, options = {}) :
 
     # Override defaults with options
-    defaults = {
-           "leaf_size": 10,
-           "keypoint_type" : "SIFT",
-           "descriptor_type" : "SIFT",
-           "only_mirror" : True,
-           "verbose" : False,
-           "max_kp" : 1000,
-           "feature_type" : 'L',
-    }
+    defaults = dict(match_defaults)
     defaults.update(options)
 
     return mirrormatch.match(paths, defaults)
@@ -69,6 +79,392 @@ def get_scores(match_fun, files, threshold = 1.0) :
     return scores_sorted, counts_sorted, labels
 
 
+####################################
+#                                  #
+#            Streaming             #
+#                                  #
+####################################
+
+
+class DescriptorIndex(object) :
+    """ Descriptor index on disk that images can be added to one at a time.
+        Descriptors are stored in shards of at most shard_size rows
+        (shard_00000_descriptors.npy, ...) together with the image index of
+        every row, and the paths of the indexed images are kept in images.txt.
+        The tree of a full shard is built once when it is first queried, and
+        the trees of the max_open_shards most recently used shards are kept in
+        memory. Images in the shard being filled get a tree each when they are
+        added. Opening an existing folder continues where the last flush left off.
+
+        With a vocabulary (see setVocabulary) the visual word of every
+        descriptor is stored as well (shard_00000_words.npy, ...), the tf-idf
+        vectors of the images are kept in memory, and queries can be
+        restricted to the shards holding the images most similar to the query
+    """
+
+    def __init__(self, folder, options = {}) :
+        self.folder             = folder
+        self.options            = dict(options)
+        self.shard_size         = options.get("shard_size", 50000)
+        self.max_open_shards    = options.get("max_open_shards", 16)
+        self.tree_type          = options.get("tree_type", "ball")
+        self.descriptor_type    = options.get("descriptor_type", "SIFT")
+        self.options["dist_metric"] = features.dist_map(self.descriptor_type)
+
+        if not os.path.isdir(folder) : os.makedirs(folder)
+
+        # Read the images and vocabulary written so far
+        images_path = os.path.join(folder, "images.txt")
+        self.images = open(images_path).read().splitlines() if os.path.exists(images_path) else []
+        self.image_set = set(self.images)
+        self.words, self.idf, self.quantize = None, None, None
+        if os.path.exists(self.vocabularyPath("words")) :
+            self.loadVocabulary(numpy.load(self.vocabularyPath("words")), numpy.load(self.vocabularyPath("idf")))
+
+        # The trees of full shards and the first and last image of every full shard
+        self.trees = collections.OrderedDict()
+        self.shard_images = []
+
+        # The images of the shard being filled as (descriptors, image index, words, query function)
+        self.pending = []
+
+        # The tf-idf vectors of the images, as column sliceable blocks of consecutive images
+        self.bow_blocks, self.bow_pending = [], []
+
+        # Read the shards written so far. The last shard keeps being filled if it isn't full
+        nb_files = len([f for f in os.listdir(folder) if f.startswith("shard_") and f.endswith("_images.npy")])
+        self.nb_shards = 0
+        W_pending, I_pending = numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int32)
+        for i in range(nb_files) :
+            D, I = self.loadShard(i)
+            W = numpy.load(self.shardPath(i, "words")) if self.quantize != None else None
+            if len(D) < self.shard_size and i == nb_files - 1 :
+                for image_index, start, end in imageRanges(I) :
+                    words = W[start:end] if W is not None else None
+                    self.pending.append(self.pendingImage(numpy.array(D[start:end]), image_index, words))
+                if W is not None : W_pending, I_pending = W, I
+            else :
+                self.shard_images.append((int(I[0]), int(I[-1])))
+                self.nb_shards += 1
+                if W is not None : self.addBow(W, I, int(I[-1]) + 1)
+        if self.quantize != None : self.addBow(W_pending, I_pending, len(self.images), pending = True)
+
+
+    def __len__(self) :
+        return len(self.images)
+
+
+    def __contains__(self, path) :
+        return path in self.image_set
+
+
+    def shardPath(self, i, suffix) :
+        return os.path.join(self.folder, "shard_%05i_%s.npy" % (i, suffix))
+
+
+    def vocabularyPath(self, suffix) :
+        return os.path.join(self.folder, "vocabulary_%s.npy" % suffix)
+
+
+    def loadShard(self, i) :
+        return (numpy.load(self.shardPath(i, "descriptors"), mmap_mode = "r"),
+                numpy.load(self.shardPath(i, "images"), mmap_mode = "r"))
+
+
+    def loadVocabulary(self, words, idf) :
+        self.words, self.idf = words, idf
+        self.quantize = vocabulary.quantizer(words, self.descriptor_type)
+
+
+    def setVocabulary(self, words, descriptor_sets) :
+        """ Sets the vocabulary used to shortlist images. The idf weights are
+            computed from a sample of descriptor sets. Must be set before any
+            image is added
+        """
+        if len(self.images) > 0 : raise Exception("The vocabulary of an index must be set before images are added")
+        quantize = vocabulary.quantizer(words, self.descriptor_type)
+        inverted, idf = vocabulary.index([quantize(D) if D is not None else [] for D in descriptor_sets], len(words))
+        for suffix, data in [("words", words), ("idf", idf)] :
+            numpy.save(self.vocabularyPath(suffix), data)
+        self.loadVocabulary(words, idf)
+
+
+    def pendingImage(self, descriptors, image_index, words, query_fun = None) :
+        if query_fun == None : query_fun = trees.init(descriptors, self.tree_type, self.options)
+        if words is None and self.quantize != None : words = self.quantize(descriptors)
+        return (descriptors, image_index, words, query_fun)
+
+
+    def addBow(self, W, I, end, pending = False) :
+        """ Adds the tf-idf vectors of the images from the last one added up to
+            end, given the word and image index of their descriptors
+        """
+        first = sum(b.shape[0] for first_b, b in self.bow_blocks) + len(self.bow_pending)
+        ranges = dict((image_index, (start, stop)) for image_index, start, stop in imageRanges(I))
+        word_sets = [W[ranges[i][0]:ranges[i][1]] if i in ranges else [] for i in range(first, end)]
+        if len(word_sets) == 0 : return
+        rows = vocabulary.tfidf(word_sets, len(self.words), self.idf)
+        if pending :
+            self.bow_pending.extend(rows[i] for i in range(rows.shape[0]))
+        else :
+            self.appendBlock(first, rows)
+
+
+    def appendBlock(self, first, rows) :
+        """ Adds the tf-idf vectors of the images from first on as a block """
+        self.bow_blocks.append((first, rows.tocsc()))
+
+        # Merge blocks of similar size so there are only logarithmically many
+        while len(self.bow_blocks) > 1 and self.bow_blocks[-2][1].shape[0] <= 2 * self.bow_blocks[-1][1].shape[0] :
+            (first_a, a), (first_b, b) = self.bow_blocks[-2:]
+            self.bow_blocks[-2:] = [(first_a, scipy.sparse.vstack((a, b)).tocsc())]
+
+
+    def add(self, path, descriptors, query_fun = None) :
+        """ Adds the descriptors of an image and returns the index of the image.
+            query_fun can be a tree of the descriptors built beforehand
+        """
+        image_index = len(self.images)
+        self.images.append(path)
+        self.image_set.add(path)
+        words = None
+        if descriptors is not None and len(descriptors) > 0 :
+            descriptors = numpy.asarray(descriptors)
+            self.pending.append(self.pendingImage(descriptors, image_index, None, query_fun))
+            words = self.pending[-1][2]
+        if self.quantize != None :
+            words = words if words is not None else numpy.zeros(0, dtype=numpy.int64)
+            self.bow_pending.append(vocabulary.tfidf([words], len(self.words), self.idf))
+
+        # Close the shard when it is full
+        if sum(len(p[0]) for p in self.pending) >= self.shard_size :
+            self.flush()
+            self.shard_images.append((self.pending[0][1], self.pending[-1][1]))
+            self.nb_shards += 1
+            self.pending = []
+            if self.quantize != None :
+                self.appendBlock(image_index + 1 - len(self.bow_pending), scipy.sparse.vstack(self.bow_pending))
+                self.bow_pending = []
+        return image_index
+
+
+    def flush(self) :
+        """ Writes the shard being filled and the list of images to disk """
+        if len(self.pending) > 0 :
+            data = [("descriptors", numpy.concatenate([p[0] for p in self.pending])),
+                    ("images", numpy.concatenate([numpy.ones(len(p[0]), dtype=numpy.int32) * p[1] for p in self.pending]))]
+            if self.quantize != None : data.append(("words", numpy.concatenate([p[2] for p in self.pending])))
+            for suffix, values in data :
+                tmp_path = "%s.%i.tmp.npy" % (self.shardPath(self.nb_shards, suffix)[:-4], os.getpid())
+                numpy.save(tmp_path, values)
+                os.rename(tmp_path, self.shardPath(self.nb_shards, suffix))
+        tmp_path = os.path.join(self.folder, "images.txt.%i.tmp" % os.getpid())
+        with open(tmp_path, "w") as f :
+            f.write("".join("%s\n" % p for p in self.images))
+        os.rename(tmp_path, os.path.join(self.folder, "images.txt"))
+
+
+    def getTree(self, i) :
+        """ Returns the query function of a full shard, keeping the most recently used around """
+        if i in self.trees :
+            self.trees[i] = self.trees.pop(i)
+        else :
+            if len(self.trees) >= self.max_open_shards :
+                self.trees.popitem(last = False)
+            D, I = self.loadShard(i)
+            self.trees[i] = (trees.init(numpy.array(D), self.tree_type, self.options), I, len(D))
+        return self.trees[i]
+
+
+    def candidates(self, D, n) :
+        """ Returns the indices of the n indexed images most similar to the
+            descriptors D by their tf-idf vectors. Needs a vocabulary
+        """
+        q = vocabulary.tfidf([self.quantize(D)], len(self.words), self.idf)
+        if q.nnz == 0 : return numpy.zeros(0, dtype=numpy.int64)
+
+        # Only the columns of the words in the query are touched
+        blocks = [b for first, b in self.bow_blocks]
+        if len(self.bow_pending) > 0 : blocks.append(scipy.sparse.vstack(self.bow_pending).tocsc())
+        scores = numpy.concatenate([numpy.asarray(b[:, q.indices].dot(q.data)).ravel() for b in blocks])
+        best = numpy.argsort(-scores, kind="mergesort")[:n]
+        return best[scores[best] > 0]
+
+
+    def query(self, D, k, candidates = None) :
+        """ Returns the distances and image indices of the k nearest indexed
+            descriptors of every row in D, as two arrays of shape (len(D), k).
+            Missing neighbours have distance inf and image index -1. If
+            candidates is a list of image indices only the shards holding
+            these images are searched
+        """
+        dist = numpy.ones((len(D), k)) * numpy.inf
+        images = -1 * numpy.ones((len(D), k), dtype=numpy.int32)
+
+        # Find the shards holding the candidates
+        if candidates is None :
+            shards = range(self.nb_shards)
+            wanted = None
+
+            # Visit the shards with a tree in memory first, so only the others are rebuilt
+            shards = [i for i in shards if i in self.trees] + [i for i in shards if not i in self.trees]
+        else :
+            candidates = numpy.asarray(candidates, dtype=numpy.int64)
+            firsts = numpy.array([first for first, last in self.shard_images], dtype=numpy.int64)
+            lasts = numpy.array([last for first, last in self.shard_images], dtype=numpy.int64)
+            shards = numpy.searchsorted(firsts, candidates, side = "right") - 1
+            inside = (shards >= 0) & (candidates <= lasts[numpy.maximum(shards, 0)]) if len(firsts) > 0 else numpy.zeros(len(shards), dtype=bool)
+            shards = [int(i) for i in numpy.unique(shards[inside])]
+            wanted = set(candidates.tolist())
+
+        def queries() :
+            for i in shards :
+                yield self.getTree(i)
+            for descriptors, image_index, words, query_fun in self.pending :
+                if wanted is None or image_index in wanted :
+                    yield (query_fun, numpy.ones(len(descriptors), dtype=numpy.int32) * image_index, len(descriptors))
+
+        # Merge the k nearest neighbours of every shard
+        for query_fun, I, size in queries() :
+            idx_s, dist_s = map(numpy.array, zip(*query_fun(D, min(k, size))))
+            dist = numpy.hstack((dist, dist_s))
+            images = numpy.hstack((images, numpy.asarray(I)[idx_s]))
+            order = numpy.argsort(dist, axis = 1, kind = "mergesort")[:, :k]
+            rows = numpy.arange(len(D))[:, None]
+            dist, images = dist[rows, order], images[rows, order]
+
+        return dist, images
+
+
+
+def imageRanges(I) :
+    """ Returns (image index, start, end) of every run of an image index in I """
+    I = numpy.asarray(I)
+    if len(I) == 0 : return []
+    starts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(I))[0] + 1))
+    ends = numpy.concatenate((starts[1:], [len(I)]))
+    return [(int(I[s]), int(s), int(e)) for s, e in zip(starts, ends)]
+
+
+
+def stream_matches(paths, index_folder, options = {}) :
+    """ Adds the images one at a time to the index in index_folder and yields
+        the candidate matches of every image as soon as it has been added:
+        (image index, matched image indices, scores, ratios), one entry per
+        match. Like the default mirror match in get_matches every descriptor
+        is matched to its two nearest neighbours in other images, and the
+        ratio is taken to the second nearest neighbour among all descriptors,
+        but only images indexed before it are searched. Images already in the
+        index are skipped, so an interrupted run can be resumed.
+
+        With options["candidate_k"] set, a vocabulary is trained on the first
+        vocabulary_images images (when the index has none yet) and only the
+        shards holding the candidate_k most similar images are searched, so
+        the cost per image doesn't grow with the size of the index
+    """
+
+    # Override defaults with options
+    defaults = dict(match_defaults)
+    defaults.update(options)
+    flush_every         = defaults.get("flush_every", 100)
+    candidate_k         = defaults.get("candidate_k", None)
+    vocabulary_images   = defaults.get("vocabulary_images", 500)
+
+    index = DescriptorIndex(index_folder, defaults)
+
+    # Train the vocabulary on a sample, keeping the features for the loop below
+    sample = {}
+    if candidate_k != None and index.quantize == None :
+        sample = dict((p, features.getImageFeatures(p, defaults)[1]) for p in paths[:vocabulary_images])
+        descriptor_sets = [d for d in sample.values() if d is not None and len(d) > 0]
+        index.setVocabulary(vocabulary.train(descriptor_sets, defaults), descriptor_sets)
+
+    for n, path in enumerate(paths) :
+        if path in index : continue
+        ds = sample.pop(path) if path in sample else features.getImageFeatures(path, defaults)[1]
+        own = trees.init(ds, index.tree_type, index.options) if ds is not None and len(ds) > 0 else None
+
+        # Match against the images indexed so far
+        if len(index) > 0 and own != None :
+            candidates = index.candidates(ds, candidate_k) if candidate_k != None else None
+            dist_target, image_target = index.query(ds, 2, candidates)
+
+            # Second nearest neighbour among all descriptors (self is the nearest in its own image)
+            dist_own = numpy.array([d for i, d in own(ds, min(3, len(ds)))])[:, 1:]
+            dist_all = numpy.sort(numpy.hstack((dist_own, dist_target)), axis = 1)[:, 1]
+
+            found = (image_target >= 0) & numpy.isfinite(dist_all)[:, None]
+            ratios = dist_target / dist_all[:, None]
+            yield len(index), image_target[found], dist_target[found], ratios[found]
+
+        index.add(path, ds, own)
+        if n % flush_every == 0 : index.flush()
+
+    index.flush()
+
+
+
+def candidate_matches(paths, options = {}) :
+    """ Shortlists the candidate_k most similar images of every image with a
+        bag of visual words and runs mirror match on the candidate pairs only.
+        The features of every image are extracted once and reused for the
+        vocabulary and for matching. Yields the matches of every pair in the
+        same format as stream_matches
+    """
+
+    # Override defaults with options
+    defaults = dict(match_defaults)
+    defaults.update(options)
+    k = defaults.get("candidate_k", 5)
+
+    keypoint_sets, descriptor_sets = zip(*[features.getImageFeatures(p, defaults) for p in paths])
+    for i, j in vocabulary.candidates(descriptor_sets, k, defaults) :
+        indices = numpy.array([0] * len(descriptor_sets[i]) + [1] * len(descriptor_sets[j]))
+        positions = numpy.array(features.getPositions(numpy.concatenate((keypoint_sets[i], keypoint_sets[j]))))
+        ds = numpy.concatenate((descriptor_sets[i], descriptor_sets[j]))
+        match_data = features.match(ds, indices, defaults)
+        positions, s, u, images, pairs = mirrormatch.getMatchResult(match_data, indices, positions)(numpy.inf)
+        if len(u) > 0 : yield i, numpy.ones(len(u), dtype=numpy.int32) * j, s, u
+
+
+
+def stream_scores(matches, nb_images, threshold = 1.0, batch_size = 1000000) :
+    """ Accumulates scores and counts like get_scores from the output of
+        stream_matches or candidate_matches in two sparse matrices of size
+        nb_images x nb_images. Every match is added to both (i,j) and (j,i),
+        so the matrices are symmetric. candidate_matches runs mirror match on
+        each pair, so its cells equal those of get_scores on that pair alone.
+        stream_matches only matches an image against the images indexed
+        before it, so only the matches from the later image of a pair are
+        counted and the cells hold roughly half of what get_scores finds.
+        Buffered entries are summed into the matrices every batch_size entries
+    """
+    scores = scipy.sparse.csr_matrix((nb_images, nb_images))
+    counts = scipy.sparse.csr_matrix((nb_images, nb_images))
+    buffered = []
+
+    def collect(scores, counts) :
+        rows, cols, s = map(numpy.concatenate, zip(*buffered))
+        add = lambda values : scipy.sparse.coo_matrix((values, (rows, cols)), shape = (nb_images, nb_images)).tocsr()
+        return scores + add(s), counts + add(numpy.ones(len(s)))
+
+    for i, js, s, u in matches :
+        keep = u < threshold
+        js, u = js[keep], u[keep]
+        score = (1/(u / threshold)) - 1
+        i_s = numpy.ones(len(js), dtype=numpy.int32) * i
+
+        # Add to both (i,j) and (j,i)
+        buffered.append((numpy.concatenate((i_s, js)), numpy.concatenate((js, i_s)), numpy.concatenate((score, score))))
+        if sum(len(b[0]) for b in buffered) >= batch_size :
+            scores, counts = collect(scores, counts)
+            buffered = []
+
+    if len(buffered) > 0 : scores, counts = collect(scores, counts)
+    return scores, counts
+
+
+
 def sigmoid(x):
   return 1 / (1 + math.exp(-x))
 
@@ -17,6 +17,7 @@ import display
 import features as f
 import sys
 import math
+import multiprocessing
 from itertools import combinations
 
 
@@ -55,38 +56,97 @@ def imageToImage(images, paths, keypoint_type, descriptor_type, score_fun = lamb
 
 
 
-def matchDescriptors(descriptors, paths, descriptor_type, score_fun) :
-
-	default_map = {
-		"SIFT"   : 1,
-		"SURF"   : 1,
-		"ORB"    : 100,
-		"BRISK"  : 100,
-		"BRIEF"  : 100,
-		"FREAK"  : 100
-	}
-
-	def filterNone(l) : return [i for i in l if i != None]
-	def getScore(D1, D2, i) :
-		if D1 == None or D2 == None : return default_map[descriptor_type]
-		indices, scores, uniques = f.bfMatch(descriptor_type, D1, D2)
-		if indices == None : return default_map[descriptor_type]
-
-		noNones = map(filterNone, [indices, scores, uniques])
-		return score_fun(*noNones)
+def matchDescriptors(descriptors, paths, descriptor_type, score_fun, pairs = None, workers = 1, chunksize = 100, progress = None) :
+	""" Scores pairs of images. If pairs is None every pair is scored, otherwise
+	    only the pairs (i, j) of indices in pairs (e.g. from vocabulary.candidates).
+	    With workers > 1 the pairs are scored in a pool of processes, chunksize
+	    pairs at a time, and progress(nb_done, nb_pairs) is called as chunks finish
+	"""
 
 	# Get all pairings of descriptors and labels
-	desc_pairs = list(combinations(descriptors,2))
-	path_pairs = list(combinations(paths,2))
+	if pairs == None :
+		pairs = list(combinations(range(len(descriptors)),2))
+	path_pairs = [(paths[i], paths[j]) for i, j in pairs]
 
 	# Print status
 	print("=") * (int(len(path_pairs) / 100) +1)
 
-	score = [((f.getLabel(p1) == f.getLabel(p2)), getScore(D1, D2, i), (p1, p2))
-			for ((D1, D2), (p1, p2), i) 
-			in zip( desc_pairs, path_pairs, range(len(path_pairs)) )]
+	scores = scorePairs(descriptors, pairs, descriptor_type, score_fun, workers, chunksize, progress)
+	score = [((f.getLabel(p1) == f.getLabel(p2)), s, (p1, p2))
+			for (s, (p1, p2)) in zip(scores, path_pairs)]
 
 	# Add a newline
 	print("")
 
 	return score
+
+
+
+# The descriptors and score function of the pairs being scored. The worker
+# processes inherit it when they are forked, so the descriptors are shared
+# with them instead of being pickled for every pair
+shared_pairs = {}
+
+def scorePairs(descriptors, pairs, descriptor_type, score_fun, workers = 1, chunksize = 100, progress = None) :
+	""" Returns the score of every pair (i, j) of indices into descriptors """
+	shared_pairs.update({
+		"descriptors" : descriptors,
+		"descriptor_type" : descriptor_type,
+		"score_fun" : score_fun,
+	})
+	chunks = [pairs[i:i+chunksize] for i in range(0, len(pairs), chunksize)]
+
+	def collect(results) :
+		scores = []
+		for chunk_scores in results :
+			scores.extend(chunk_scores)
+			if progress != None : progress(len(scores), len(pairs))
+		return scores
+
+	try :
+		if workers > 1 and len(chunks) > 1 :
+			pool = multiprocessing.Pool(workers)
+			try :
+				return collect(pool.imap(scoreChunk, chunks))
+			finally :
+				pool.close()
+				pool.join()
+		else :
+			return collect(scoreChunk(c) for c in chunks)
+	finally :
+		shared_pairs.clear()
+
+
+
+def scoreChunk(pairs) :
+	""" Scores a list of pairs using shared_pairs. Every process reuses one matcher """
+	descriptors = shared_pairs["descriptors"]
+	descriptor_type = shared_pairs["descriptor_type"]
+	if not "matcher" in shared_pairs :
+		shared_pairs["matcher"] = f.bfMatcher(descriptor_type)
+	return [pairScore(descriptors[i], descriptors[j], descriptor_type, shared_pairs["score_fun"], shared_pairs["matcher"]) for i, j in pairs]
+
+
+
+def pairScore(D1, D2, descriptor_type, score_fun, matcher = None) :
+	""" Scores two sets of descriptors with score_fun(indices, scores, uniques),
+	    where indices is the array of indices in D2 of the best match of every
+	    matched descriptor in D1
+	"""
+
+	default_map = {
+		"SIFT"   : 1,
+		"SURF"   : 1,
+		"ORB"    : 100,
+		"BRISK"  : 100,
+		"BRIEF"  : 100,
+		"FREAK"  : 100
+	}
+
+	if D1 is None or D2 is None : return default_map[descriptor_type]
+	match_data = f.bfMatch(D1, D2, { "descriptor_type" : descriptor_type, "bf_matcher" : matcher })
+	if match_data[0] is None : return default_map[descriptor_type]
+
+	pairs, scores, uniques = map(list, zip(*match_data))
+	indices = numpy.array([j for i, j in pairs], dtype=numpy.int64)
+	return score_fun(indices, scores, uniques)
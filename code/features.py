@@ -20,6 +20,9 @@ import cv2
 import numpy
 import trees
 import collections
+import hashlib
+import os
+import multiprocessing
 from sklearn.neighbors.ball_tree import BallTree
 
 
@@ -33,6 +36,25 @@ from sklearn.neighbors.ball_tree import BallTree
 supported_keypoint_types = ["FAST","STAR","SIFT","SURF","ORB","MSER","BRISK","GFTT","HARRIS","Dense","SimpleBlob"]
 supported_descriptor_types = ["SIFT","SURF","ORB","BRISK","BRIEF","FREAK"]
 
+# Compact representation of cv2.KeyPoint. 'image' is the index of the image
+# the keypoint belongs to when returned from getFeatures
+keypoint_dtype = numpy.dtype([
+    ("x",           numpy.float32),
+    ("y",           numpy.float32),
+    ("size",        numpy.float32),
+    ("angle",       numpy.float32),
+    ("response",    numpy.float32),
+    ("octave",      numpy.int32),
+    ("class_id",    numpy.int32),
+    ("image",       numpy.int32)])
+
+# Version of the feature cache layout, part of the cache key. Bump it when
+# keypoint_dtype or the cached files change so old caches aren't loaded
+cache_version = 2
+
+# Options that change how features are extracted from an image
+feature_option_keys = ["keypoint_type", "descriptor_type", "feature_type", "max_kp", "shuffle", "feature_verbose", "feature_cache", "keypoint_format"]
+
 
 ####################################
 #                                  #
@@ -45,30 +67,22 @@ def getFeatures(paths, options = {}) :
     """ Given a list of paths to images, the function returns a list of 
         descriptors and keypoints
         Input: paths [list of strings] The paths to the images we are using
-               options [dictionary of options] shuffle, group, max_kp, keypoint_type, descriptor_type
-        Out:   [pair of list of descriptors and list of keypoints]
+               options [dictionary of options] shuffle, group, max_kp, keypoint_type, descriptor_type, 
+                                               feature_cache, feature_workers, feature_chunksize, keypoint_format
+        Out:   [triple of image indices, keypoints and descriptors]. With
+               options["keypoint_format"] = "table" the keypoints are returned as
+               a structured array of type keypoint_dtype instead of cv2.KeyPoint
     """
 
     # Get options
-    shuffle             = options.get("shuffle", False)
     verbose             = options.get("feature_verbose", False)
-    feature_type        = options.get("feature_type", "L")
-    filter_features     = options.get("filter_features", numpy.array([]))
-
-    # Get all images
-    images = map(lambda i : loadImage(i, feature_type), paths)
+    workers             = options.get("feature_workers", 1)
 
-    # Find feature points
-    if shuffle :
-        keypoints = [numpy.array(getKeypoints(im, options)) for im in images]
-        map(numpy.random.shuffle, keypoints)
+    # Get keypoints and descriptors for every image
+    if workers > 1 and len(paths) > 1 :
+        data = getFeaturesParallel(paths, options)
     else :
-        keypoints = [numpy.array(getKeypoints(im, options)) for im in images]
-
-    if verbose : print("\nKeypoints collected: %s" % str(map(len,keypoints)))
-
-    # Describe featre points
-    data = [getDescriptors(im, k, options) for (im, k) in zip(images, keypoints)]
+        data = [getImageFeatures(path, options) for path in paths]
     keypoints, descriptors = zip(*data)
 
     if verbose : print("\nDescriptors calculated: %s" % str(map(len,descriptors)))
@@ -77,9 +91,149 @@ def getFeatures(paths, options = {}) :
     if sum(map(lambda d : d == None, descriptors)) > 0 : return (None, None, None)
 
     # Create a list of indices
-    indices = [numpy.array([i]*n) for i,n in zip(range(len(paths)), map(len, descriptors))]
+    indices = numpy.concatenate([numpy.array([i]*n) for i,n in zip(range(len(paths)), map(len, descriptors))])
+
+    # Tables carry the image index as well
+    keypoints = numpy.concatenate(keypoints)
+    if keypoints.dtype == keypoint_dtype : keypoints["image"] = indices
+
+    return indices, keypoints, numpy.concatenate(descriptors)
+
+
+
+def getImageFeatures(path, options = {}) :
+    """ Given the path to an image, the function returns its keypoints and descriptors.
+        If options["feature_cache"] is set to a directory, the features are looked up
+        there first and stored there after extraction. options["feature_store"] can
+        be a dict in which the features are kept in memory the same way
+        Input: path [string] The path to the image
+               options [dictionary of options] shuffle, max_kp, keypoint_type, descriptor_type, feature_type, 
+                                               feature_cache, feature_store, keypoint_format
+        Out:   [pair of numpy.ndarray of cv2.KeyPoint (or keypoint table) and numpy.ndarray of descriptors]
+    """
+
+    # Get options
+    shuffle             = options.get("shuffle", False)
+    verbose             = options.get("feature_verbose", False)
+    feature_type        = options.get("feature_type", "L")
+    feature_cache       = options.get("feature_cache", None)
+    feature_store       = options.get("feature_store", None)
+    keypoint_format     = options.get("keypoint_format", "object")
+
+    # Look up features in memory and then in cache
+    store_key = getStoreKey(path, options)
+    if feature_store != None and store_key in feature_store :
+        cached = feature_store[store_key]
+    elif feature_cache != None :
+        cache_path = getCachePath(path, feature_cache, options)
+        cached = loadCachedFeatures(cache_path)
+    else :
+        cached = None
+
+    # Keep features in memory
+    if feature_store != None and cached is not None :
+        feature_store[store_key] = cached
+
+    if cached is not None :
+        table, descriptors = cached
+        keypoints = table if keypoint_format == "table" else fromKeypointTable(table)
+    else :
+        # Get image and find feature points
+        image = loadImage(path, feature_type)
+        keypoints = numpy.array(getKeypoints(image, options))
 
-    return numpy.concatenate(indices), numpy.concatenate(keypoints), numpy.concatenate(descriptors)
+        if verbose : print("\nKeypoints collected: %i" % len(keypoints))
+
+        # Describe feature points
+        keypoints, descriptors = getDescriptors(image, keypoints, options)
+        keypoints = numpy.array(keypoints)
+
+        # Store features
+        if feature_cache != None and descriptors is not None :
+            saveCachedFeatures(cache_path, toKeypointTable(keypoints), descriptors)
+        if feature_store != None and descriptors is not None :
+            feature_store[store_key] = (toKeypointTable(keypoints), descriptors)
+
+        # Convert to table
+        if keypoint_format == "table" and descriptors is not None :
+            keypoints = toKeypointTable(keypoints)
+
+    # Shuffle keypoints and descriptors together
+    if shuffle and descriptors is not None :
+        keypoints, descriptors = shuffleFeatures(keypoints, descriptors)
+
+    return keypoints, descriptors
+
+
+
+def getFeaturesParallel(paths, options = {}) :
+    """ Extracts the features of several images using a pool of processes.
+        The result is returned in the same order as paths, so it is identical
+        to calling getImageFeatures on each path in turn. Images found in
+        options["feature_store"] aren't sent to the pool, and the features of
+        the others are put in it
+        Input: paths [list of strings] The paths to the images we are using
+               options [dictionary of options] see getImageFeatures and:
+                   feature_workers [int] Number of processes
+                   feature_chunksize [int] Number of images sent to a process at a time
+        Out:   [list of pairs of numpy.ndarray of cv2.KeyPoint and numpy.ndarray of descriptors]
+    """
+
+    # Get options
+    workers             = options.get("feature_workers", 1)
+    chunksize           = options.get("feature_chunksize", 1)
+    shuffle             = options.get("shuffle", False)
+    keypoint_format     = options.get("keypoint_format", "object")
+    feature_store       = options.get("feature_store", None)
+
+    # Look up features in memory first
+    keys = [getStoreKey(path, options) for path in paths]
+    tables = [feature_store[key] if feature_store != None and key in feature_store else None for key in keys]
+    missing = [n for n, t in enumerate(tables) if t is None]
+
+    # Only send options relevant to extraction, since the rest might not pickle.
+    # Shuffling is done here so the processes don't share random state
+    worker_options = { k : v for k, v in options.iteritems() if k in feature_option_keys }
+    worker_options["shuffle"] = False
+    worker_options["keypoint_format"] = "table"
+
+    if len(missing) > 0 :
+        pool = multiprocessing.Pool(workers)
+        try :
+            extracted = pool.map(extractFeatureTable, [(paths[n], worker_options) for n in missing], chunksize)
+        finally :
+            pool.close()
+            pool.join()
+        for n, (table, descriptors) in zip(missing, extracted) :
+            tables[n] = (table, descriptors)
+            if feature_store != None and descriptors is not None : feature_store[keys[n]] = (table, descriptors)
+
+    # cv2.KeyPoint can't be pickled so the processes return keypoint tables
+    if keypoint_format == "table" :
+        data = tables
+    else :
+        data = [(fromKeypointTable(t), d) if d is not None else (t, d) for t, d in tables]
+    if shuffle :
+        data = [shuffleFeatures(k, d) if d is not None else (k, d) for k, d in data]
+    return data
+
+
+
+def extractFeatureTable(args) :
+    """ Process pool worker for getFeaturesParallel. Takes a pair of path and options
+        and returns the keypoints as a keypoint table together with the descriptors
+    """
+    path, options = args
+    table, descriptors = getImageFeatures(path, options)
+    if descriptors is None : return numpy.array([], dtype = keypoint_dtype), None
+    return table, numpy.asarray(descriptors)
+
+
+
+def shuffleFeatures(keypoints, descriptors) :
+    """ Shuffles keypoints and descriptors with the same permutation """
+    order = numpy.random.permutation(len(keypoints))
+    return keypoints[order], descriptors[order]
 
 
 
@@ -292,16 +446,7 @@ def bfMatch(D1, D2, options = {}) :
     # Get options
     match_same          = options.get("match_same", False) 
     descriptor_type		= options.get("descriptor_type", "SIFT")
-
-    # Map for the type of distance measure to use
-    dist_map = {
-        "SIFT"   : cv2.NORM_L2,
-        "SURF"   : cv2.NORM_L2,
-        "ORB"    : cv2.NORM_HAMMING,
-        "BRISK"  : cv2.NORM_HAMMING,
-        "BRIEF"  : cv2.NORM_HAMMING,
-        "FREAK"  : cv2.NORM_HAMMING
-    }
+    matcher             = options.get("bf_matcher", None)
 
     # Map for the type of the data in the array
     type_map = {
@@ -314,10 +459,9 @@ def bfMatch(D1, D2, options = {}) :
     }
 
     dtype = type_map[descriptor_type]
-    dist = dist_map[descriptor_type]
 
-    # Now get BFMatcher
-    matcher = cv2.BFMatcher(dist)
+    # Now get BFMatcher, unless one is passed in to be reused
+    if matcher == None : matcher = bfMatcher(descriptor_type)
 
     # Make sure the array is encoded properly
     query = numpy.array(D1, dtype = dtype)
@@ -340,6 +484,23 @@ def bfMatch(D1, D2, options = {}) :
 
 
 
+def bfMatcher(descriptor_type = "SIFT") :
+    """ Returns a cv2.BFMatcher with the norm used for descriptor_type """
+
+    # Map for the type of distance measure to use
+    dist_map = {
+        "SIFT"   : cv2.NORM_L2,
+        "SURF"   : cv2.NORM_L2,
+        "ORB"    : cv2.NORM_HAMMING,
+        "BRISK"  : cv2.NORM_HAMMING,
+        "BRIEF"  : cv2.NORM_HAMMING,
+        "FREAK"  : cv2.NORM_HAMMING
+    }
+
+    return cv2.BFMatcher(dist_map[descriptor_type])
+
+
+
 def loadImage(path, feature_type = 'L') : 
     """ Given a path, an image will be loaded and converted to grayscale
         input: path [string] (path to the image)
@@ -373,11 +534,32 @@ def getLabel(path) : return " ".join(path.split("/")[-1].split("_")[0:-1])
 
 
 def getPosition(keypoint) :
+    if isinstance(keypoint, numpy.void) : return (keypoint["x"], keypoint["y"])
     return (keypoint.pt[0], keypoint.pt[1])
 
 def getPositions(keypoints) : 
+    """ Returns the positions of keypoints. For a keypoint table this is an
+        n x 2 array sliced from the table, otherwise a list of pairs
+    """
+    if isTable(keypoints) : return numpy.column_stack((keypoints["x"], keypoints["y"]))
     return map(getPosition, keypoints)
 
+def isTable(keypoints) :
+    return isinstance(keypoints, numpy.ndarray) and keypoints.dtype == keypoint_dtype
+
+
+def toKeypointTable(keypoints, image_index = 0) :
+    """ Converts a list of cv2.KeyPoint to a structured array of type keypoint_dtype """
+    if isTable(keypoints) : return keypoints
+    rows = [(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave, k.class_id, image_index) for k in keypoints]
+    return numpy.array(rows, dtype = keypoint_dtype)
+
+def fromKeypointTable(table) :
+    """ Converts a structured array of type keypoint_dtype to an array of cv2.KeyPoint """
+    keypoints = [cv2.KeyPoint(float(t["x"]), float(t["y"]), float(t["size"]), float(t["angle"]),
+                    float(t["response"]), int(t["octave"]), int(t["class_id"])) for t in table]
+    return numpy.array(keypoints)
+
 
 def flatten(it):
     for x in it:
@@ -387,6 +569,66 @@ def flatten(it):
         else:
             yield x
 
+####################################
+#                                  #
+#          Feature Cache           #
+#                                  #
+####################################
+
+def getCachePath(path, cache_dir, options = {}) :
+    """ Returns the path prefix under which the features of an image are cached.
+        The key is the cache version and the sha1 hash of the image file together
+        with the options that change how features are extracted
+    """
+    keypoint_type       = options.get("keypoint_type", "SIFT")
+    descriptor_type     = options.get("descriptor_type", "SIFT")
+    feature_type        = options.get("feature_type", "L")
+    max_kp              = options.get("max_kp", 9999)
+
+    # Hash image content
+    with open(path, "rb") as f :
+        image_hash = hashlib.sha1(f.read()).hexdigest()
+
+    key = "v%i_%s_%s_%s_%s_%i" % (cache_version, image_hash, keypoint_type, descriptor_type, feature_type, max_kp)
+    return os.path.join(cache_dir, key)
+
+
+def getStoreKey(path, options = {}) :
+    """ Returns the key of the features of an image in options["feature_store"] """
+    keypoint_type       = options.get("keypoint_type", "SIFT")
+    descriptor_type     = options.get("descriptor_type", "SIFT")
+    feature_type        = options.get("feature_type", "L")
+    max_kp              = options.get("max_kp", 9999)
+    return (os.path.abspath(path), keypoint_type, descriptor_type, feature_type, max_kp)
+
+
+def loadCachedFeatures(cache_path) :
+    """ Returns a pair of keypoint table and memory mapped descriptors or None
+        if the features haven't been cached or the table isn't a keypoint_dtype table
+    """
+    kp_path, ds_path = ("%s_keypoints.npy" % cache_path, "%s_descriptors.npy" % cache_path)
+    if not (os.path.exists(kp_path) and os.path.exists(ds_path)) : return None
+    table = numpy.load(kp_path)
+    if table.dtype != keypoint_dtype : return None
+    return table, numpy.load(ds_path, mmap_mode = "r")
+
+
+def saveCachedFeatures(cache_path, keypoint_table, descriptors) :
+    """ Stores a keypoint table and descriptors. Files are written under a
+        temporary name first so a concurrent reader never sees half a file
+    """
+    cache_dir = os.path.dirname(cache_path)
+    try :
+        os.makedirs(cache_dir)
+    except OSError :
+        if not os.path.isdir(cache_dir) : raise
+    for suffix, data in [("keypoints", keypoint_table), ("descriptors", descriptors)] :
+        tmp_path = "%s_%s_%i.tmp.npy" % (cache_path, suffix, os.getpid())
+        numpy.save(tmp_path, data)
+        os.rename(tmp_path, "%s_%s.npy" % (cache_path, suffix))
+
+
+
 ####################################
 #                                  #
 #           Exceptions             #
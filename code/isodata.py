@@ -127,9 +127,10 @@ def cluster(points, k_init=None, max_iterations=100, min_partition_size=5, max_s
             split = 0
 
             # [Step 8] For each partition check if it should be split
+            counts = numpy.bincount(partitioning)
             for j, p in enumerate(set(partitioning)) :
 
-                if splitTest(j, sds[j], max_sd, spread, numpy.sum(partitioning == p), min_partition_size, k, k_init) :
+                if splitTest(j, sds[j], max_sd, spread, counts[p], min_partition_size, k, k_init) :
                     # Split the partition according to the highest sd direction
                     split += 1
                     centers = splitPartition(centers, sds[j], j, k)
@@ -194,9 +195,12 @@ def mergePartitions(ds_pairs, centers, partitioning, min_distance, max_mergers)
 
 
 def partitionDist(centers) :
+    """ Returns a sorted list of (distance, (i, j)) for all pairs of centers """
     k = centers.shape[0]
-    def d(i,j) : return numpy.linalg.norm(centers[i] - centers[j])
-    return sorted([(d(i,j), (i,j)) for i,j in combinations(range(k),2)])
+    i, j = numpy.triu_indices(k, 1)
+    d = norms(centers[i] - centers[j])
+    order = numpy.lexsort((j, i, d))
+    return [(d_ij, (i_ij, j_ij)) for d_ij, i_ij, j_ij in zip(d[order], i[order], j[order])]
 
 
 
@@ -223,43 +227,92 @@ def splitTest(j, sd_j, max_sd, spread, n_j, min_partition_size, k, k_init) :
 
 
 def getSD(partitioning, centers, points) :
-    def sd(points, center) : return numpy.sqrt(numpy.var(points - center, axis = 0))
-    sds = [sd(points[partitioning == p], centers[p]) for p in set(partitioning)]
-    return numpy.array(sds)
+    labels = partitionLabels(partitioning)
+    counts = partitionCounts(partitioning, labels)
+
+    # var(points - center) per dimension, summing in the same order as numpy.var
+    diff = points - centers[partitioning]
+    means = columnSums(partitioning, diff, labels) / counts[:, numpy.newaxis]
+    diff = diff - means[partitionIndex(partitioning, labels)]
+    return numpy.sqrt(columnSums(partitioning, diff * diff, labels) / counts[:, numpy.newaxis])
 
 
 
 def getPartitionSpread(partitioning, centers, points) :
-    def getDists(rows) : return [numpy.linalg.norm(row) for row in rows]
-    spread = [numpy.mean(getDists(points[partitioning == p] - centers[p])) for p in set(partitioning)]
-    return numpy.array(spread)
+    labels = partitionLabels(partitioning)
+    dists = norms(points - centers[partitioning])
+
+    # numpy.mean sums pairwise, so the mean is taken over each partition's slice
+    order = numpy.argsort(partitioning, kind = "mergesort")
+    sorted_labels = partitioning[order]
+    starts = numpy.searchsorted(sorted_labels, labels, side = "left")
+    ends = numpy.searchsorted(sorted_labels, labels, side = "right")
+    return numpy.array([numpy.mean(dists[order[s:e]]) for s, e in zip(starts, ends)])
 
 
 
 def getCenters(partitioning, points) :
-    def getCenter(p) : return numpy.mean(points[partitioning == p], axis=0)
-    return numpy.array([getCenter(p) for p in set(partitioning) if p != -1])
+    labels = [p for p in partitionLabels(partitioning) if p != -1]
+    counts = partitionCounts(partitioning, labels)
+    return columnSums(partitioning, points, labels) / counts[:, numpy.newaxis]
 
 
 
 def removePartitions(partitioning, treshold) :
-    # Counter for how many partitions where removed
-    removed = 0
-    
-    # Check for partitions that are too small
-    for p in range(numpy.max(partitioning)) :
-        if numpy.sum(partitioning == p) < treshold :
-            partitioning[partitioning == p] = -1
-            removed += 1
-    
-    return removed
+    # Check for partitions that are too small (the largest label is never removed)
+    nb_labels = numpy.max(partitioning)
+    if nb_labels <= 0 : return 0
+    counts = numpy.bincount(partitioning[partitioning >= 0], minlength = nb_labels)[:nb_labels]
+    small = counts < treshold
 
+    # Mark the points of small partitions and count how many partitions where removed
+    partitioning[(partitioning >= 0) & (partitioning < nb_labels) & small[numpy.clip(partitioning, 0, nb_labels - 1)]] = -1
+    return int(numpy.sum(small))
 
 
-def pickCenter(centers, points) :
-    
-    def closestCenter(centers, p) :
-        ds = [numpy.linalg.norm(c - p) for c in centers]
-        return numpy.argmin(ds)
-    
-    return numpy.array([closestCenter(centers, p) for p in points])
+
+def pickCenter(centers, points, block_size = 10000) :
+    """ Returns the index of the closest center for every point """
+    closest = numpy.empty(len(points), dtype=numpy.int64)
+    for i in range(0, len(points), block_size) :
+        diff = points[i:i+block_size, numpy.newaxis, :] - centers[numpy.newaxis, :, :]
+        closest[i:i+block_size] = numpy.argmin(numpy.sqrt((diff * diff).sum(axis=2)), axis=1)
+    return closest
+
+
+
+def norms(rows) :
+    """ Length of every row. The same as numpy.linalg.norm(row) for 2d points """
+    return numpy.sqrt((rows * rows).sum(axis=1))
+
+
+
+def partitionLabels(partitioning) :
+    """ The partitions in the order of set(partitioning) """
+    return list(set(partitioning.tolist()))
+
+
+
+def partitionCounts(partitioning, labels) :
+    """ Number of points in each partition in labels """
+    counts = numpy.bincount(partitioning + 1)
+    return counts[numpy.array(labels, dtype=numpy.int64) + 1]
+
+
+
+def partitionIndex(partitioning, labels) :
+    """ Maps every point to the position of its partition in labels """
+    index = numpy.zeros(numpy.max(partitioning) + 2, dtype=numpy.int64)
+    index[numpy.array(labels)] = numpy.arange(len(labels))
+    return index[partitioning]
+
+
+
+def columnSums(partitioning, values, labels) :
+    """ Sums values per partition (rows in labels order). bincount adds the
+        values of each partition in index order like numpy.sum(axis = 0) does
+    """
+    size = numpy.max(partitioning) + 2
+    shifted = partitioning + 1
+    sums = numpy.array([numpy.bincount(shifted, weights = values[:, d], minlength = size) for d in range(values.shape[1])]).T
+    return sums[numpy.array(labels, dtype=numpy.int64) + 1]
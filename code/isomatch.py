@@ -30,7 +30,7 @@ def match(paths, options = {}) :
 
     # Get matches in usual format
     def matchFromIndex(i,j) :
-        return (features.getPosition(ks[indices == 0][i]), features.getPosition(ks[indices == 1][j]))
+        return (positions_1[i], positions_2[j])
 
     # Get options
     k_init				= options.get("k_init", 50)
@@ -51,6 +51,7 @@ def match(paths, options = {}) :
 
     # Get positions
     positions = numpy.array(features.getPositions(ks))
+    positions_1, positions_2 = (positions[indices == 0], positions[indices == 1])
 
     # Get matches
     match_points = getMatchPoints(indices, ks, ds, descriptor_type = descriptor_type)
@@ -72,10 +73,11 @@ def match(paths, options = {}) :
     partition_links = [getPartitionLinks(row) for row in part_corr]
 
     # Get all keypoint matches from the matching clusters
+    match_groups = groupMatches(match_points, part_1, part_2)
     match_set = []
     for i,ms in enumerate(partition_links) :
         for (j,s) in ms :
-            match_set.extend(getPartitionMatches(match_points, part_1 == i, part_2 == j))
+            match_set.extend(getPartitionMatches(match_groups, i, j))
     
     # def match_fun(threshold) :
     #     # For each partition figure out which partitions correspond
@@ -85,7 +87,7 @@ def match(paths, options = {}) :
     #     match_set = []
     #     for i, ms in enumerate(partition_links) :
     #         for (j, s) in ms :
-    #             match_set.extend(getPartitionMatches(match_points, part_1 == i, part_2 == j))
+    #             match_set.extend(getPartitionMatches(match_groups, i, j))
     #     match_data = [(matchFromIndex(i, j), u, 0) for((i,j),u) in match_set if u < ratio_threshold]
     #     if len(match_data) == 0 : return [], [], []
     #     matches, ratios, scores = zip(*match_data)
@@ -140,9 +142,11 @@ def getLinkMat(part_1, part_2, match_points) :
     n = len(set(part_1))
     m = len(set(part_2))
     part_corr = numpy.zeros((n, m))
-    for p_1 in set(part_1) :
-        for p_2 in set(part_2) :
-            part_corr[p_1,p_2] = linkCount(match_points, part_1 == p_1, part_2 == p_2)
+    if len(match_points) == 0 : return part_corr
+
+    # Count all matches in one pass
+    (i, j) = numpy.array([m_ij for m_ij, u in match_points]).T
+    numpy.add.at(part_corr, (part_1[i], part_2[j]), 1)
 
     return part_corr
 
@@ -150,22 +154,31 @@ def getLinkMat(part_1, part_2, match_points) :
 def getMatchPoints(indices, ks, ds, descriptor_type = "SIFT") :
 
     # Use cv2's matcher to get matching feature points
-    bfMatches = features.bfMatch(descriptor_type, ds[indices == 0], ds[indices == 1])
+    bfMatches = features.bfMatch(ds[indices == 0], ds[indices == 1], { "descriptor_type" : descriptor_type })
+    if bfMatches[0] == None : return []
 
     # Keep relevant data
-    match_points = [((j, i), u) for j,(i,s,u) in enumerate(zip(*bfMatches)) if i != None]
+    match_points = [((j, i), u) for (j, i), s, u in bfMatches]
 
     return match_points
 
 
-# Get matches that pertain to part_1 in image_1 and part_2 in image_2
-def getPartitionMatches(match_points, part_1_mask, part_2_mask) :
-    return [((i,j),u) for ((i,j), u) in match_points if part_1_mask[i] and part_2_mask[j]]
+# Group the matches by the partition in image_1 and the partition in image_2
+def groupMatches(match_points, part_1, part_2) :
+    if len(match_points) == 0 : return {}
+    (i, j) = numpy.array([m_ij for m_ij, u in match_points]).T
+    keys = part_1[i] * (numpy.max(part_2) + 1) + part_2[j]
 
+    # Sort the matches by group, keeping their order within a group
+    order = numpy.argsort(keys, kind="mergesort")
+    starts = numpy.nonzero(numpy.append(True, keys[order][1:] != keys[order][:-1]))[0]
+    ends = numpy.append(starts[1:], len(order))
+    return { (part_1[i[order[s]]], part_2[j[order[s]]]) : [match_points[k] for k in order[s:e]] for s, e in zip(starts, ends) }
 
-# Count matches that pertain to part_1 in image_1 and part_2 in image_2
-def linkCount(match_points, part_1_mask, part_2_mask) : 
-    return len(getPartitionMatches(match_points, part_1_mask, part_2_mask))
+
+# Get matches that pertain to part_1 in image_1 and part_2 in image_2
+def getPartitionMatches(match_groups, p_1, p_2) :
+    return match_groups.get((p_1, p_2), [])
 
 
 # For each partition figure out which partitions correspond
@@ -15,6 +15,8 @@ Jonas Toft Arnfred, 2013-03-28
 ####################################
 
 import numpy
+import scipy.sparse
+import time
 #from itertools import groupby
 
 ####################################
@@ -24,7 +26,140 @@ import numpy
 ####################################
 
 
-def cluster(weights, verbose=False) :
+def cluster(weights, verbose=False, levels=1) :
+    """ Clusters the graph given by weights using the sparse louvain implementation.
+        Input: weights [numpy.ndarray or scipy.sparse matrix] Symmetric adjecency matrix of the graph
+               verbose [boolean] Print progress
+               levels [int] Number of times the graph is aggregated and clustered again. 
+                            With levels = 1 the result is the same as cluster_dense
+        Out:   [numpy.ndarray] partition label per vertex
+    """
+    W = scipy.sparse.csr_matrix(weights, dtype=numpy.float64)
+    W.eliminate_zeros()
+    K = W.sum()
+    partitions = numpy.arange(0, W.shape[0])
+    if K == 0 : return partitions
+
+    # With a single level the labels are vertex indices like in cluster_dense
+    if levels <= 1 : return local_moving(W, K, verbose)
+
+    self_loops = None
+    for level in range(levels) :
+        level_partitions = local_moving(W, K, verbose, self_loops)
+
+        # Relabel from 0, map back to the vertices and aggregate the graph
+        labels, level_partitions = numpy.unique(level_partitions, return_inverse=True)
+        partitions = level_partitions[partitions]
+        if len(labels) == W.shape[0] : break
+        W, self_loops = aggregate(W, self_loops, level_partitions, len(labels))
+
+    return partitions
+
+
+def local_moving(W, K, verbose=False, self_loops=None) :
+    """ One level of louvain on the csr matrix W with total weight K. Vertices
+        are visited and moved exactly as in cluster_dense, but the total and
+        internal weight of every partition is kept in arrays and updated when a
+        vertex moves instead of being recomputed from masks of the full matrix.
+        self_loops is the weight of aggregated vertices kept outside of W, so that
+        it moves with the vertex without counting as an edge to its partition
+    """
+    n = W.shape[0]
+    WT = W.T.tocsr()
+    partitions = numpy.arange(0, n)
+    if self_loops is None : self_loops = numpy.zeros(n)
+    degree = numpy.asarray(W.sum(axis=1)).ravel() + self_loops
+    diagonal = W.diagonal()
+    rows = numpy.repeat(numpy.arange(n), numpy.diff(W.indptr))
+    moved = 1
+    m = 0
+    m_diff = 1
+    while (m_diff > 0 and moved > 0) :
+        # Partition totals are recomputed once per sweep so rounding doesn't accumulate
+        same = partitions[rows] == partitions[W.indices]
+        p_total = numpy.bincount(partitions, weights=degree, minlength=n).astype(numpy.float64)
+        p_internal = numpy.bincount(partitions[rows[same]], weights=W.data[same], minlength=n).astype(numpy.float64)
+        p_internal += numpy.bincount(partitions, weights=self_loops, minlength=n)
+
+        moved = 0
+        delta_Q = 0
+        for index in range(n) :
+            delta = move_sparse(W, WT, index, partitions, K, degree[index], diagonal[index], self_loops[index], p_total, p_internal)
+            if delta > 0 :
+                moved += 1
+                delta_Q += delta
+        m_old = m
+        m = numpy.sum(p_internal / K - (p_total / K) ** 2)
+        m_diff = m - m_old
+        if verbose : 
+            print("Moved %i vertices (modularity now: %.6f, change of %.6f (%.6f))" % (moved,m,m_diff,delta_Q))
+    return partitions
+
+
+def move_sparse(W, WT, index, partitions, K, k_v, w_vv, s_v, p_total, p_internal) :
+    """ Same as move, but for a csr matrix W (and its transpose WT) with partition 
+        totals kept in p_total and p_internal, which are updated if the vertex is moved.
+        w_vv is the diagonal of W and s_v the self loop kept outside of W
+    """
+    start, end = (W.indptr[index], W.indptr[index+1])
+    if start == end : return 0
+
+    # Weight from index to every neighbouring partition
+    prospects, inverse = numpy.unique(partitions[W.indices[start:end]], return_inverse=True)
+    k_v_p = numpy.bincount(inverse, weights=W.data[start:end])
+
+    # See how much we would gain from moving p back to orig_partition
+    old_partition = partitions[index]
+    k_v_old = k_v_p[prospects == old_partition].sum()
+    lost_Q = deltaQ_sparse(k_v_old, k_v, p_total[old_partition], p_internal[old_partition], K)
+
+    # What is the best gain elsewhere? Ties go to the highest partition like in move
+    prospect_Q = deltaQ_sparse(k_v_p, k_v, p_total[prospects], p_internal[prospects], K)
+    best = len(prospect_Q) - 1 - numpy.argmax(prospect_Q[::-1])
+
+    # Is it worth moving?
+    delta = prospect_Q[best] - lost_Q
+    if (delta > 0.000001) :
+        new_partition = prospects[best]
+
+        # Incoming edges, which differ from the outgoing ones if W isn't symmetric
+        col_start, col_end = (WT.indptr[index], WT.indptr[index+1])
+        col_partitions = partitions[WT.indices[col_start:col_end]]
+        col_data = WT.data[col_start:col_end]
+        k_old_v = col_data[col_partitions == old_partition].sum()
+        k_new_v = col_data[col_partitions == new_partition].sum()
+
+        p_total[old_partition] -= k_v
+        p_internal[old_partition] -= k_v_old + k_old_v - w_vv + s_v
+        p_total[new_partition] += k_v
+        p_internal[new_partition] += k_v_p[best] + k_new_v + w_vv + s_v
+        partitions[index] = new_partition
+        return delta
+    else :
+        return 0
+
+
+# Gain in Q from moving a vertex with k_v_p edges to partition
+def deltaQ_sparse(k_v_p, k_v, p_total, p_internal, K) :
+    v_weight = 2.0 * k_v_p
+    k_neighbours = 2.0 * p_total - p_internal
+    return 1.0/K * (v_weight - (k_v * k_neighbours + k_v**2) / K)
+
+
+def aggregate(W, self_loops, partitions, nb_partitions) :
+    """ Returns the graph where every partition is a vertex together with the
+        internal weight of every partition, which is kept as a separate self loop
+    """
+    P = scipy.sparse.csr_matrix((numpy.ones(W.shape[0]), (numpy.arange(W.shape[0]), partitions)), shape=(W.shape[0], nb_partitions))
+    W_p = (P.T.dot(W).dot(P)).tocsr()
+    internal = W_p.diagonal()
+    if self_loops is not None : internal = internal + numpy.bincount(partitions, weights=self_loops, minlength=nb_partitions)
+    W_p = (W_p - scipy.sparse.diags(W_p.diagonal(), 0)).tocsr()
+    W_p.eliminate_zeros()
+    return W_p, internal
+
+
+def cluster_dense(weights, verbose=False) :
     indices = numpy.arange(0, weights.shape[0])
     partitions = indices.copy()
     K = numpy.sum(weights)
@@ -97,3 +232,19 @@ def modularity(weights, partitions) :
 
     ms = [mod_part(partitions==p) for p in set(partitions)]
     return sum(ms)
+
+
+def benchmark(weights, verbose=False) :
+    """ Times cluster_dense against the sparse cluster on the same weights and
+        checks that they find the same partitions
+    """
+    start = time.time()
+    partitions_dense = cluster_dense(weights, verbose)
+    time_dense = time.time() - start
+
+    start = time.time()
+    partitions_sparse = cluster(weights, verbose)
+    time_sparse = time.time() - start
+
+    same = numpy.all(partitions_dense == partitions_sparse)
+    return { "dense" : time_dense, "sparse" : time_sparse, "same" : same }
@@ -16,6 +16,7 @@ import isodata
 import features
 import louvain
 import weightMatrix
+import clustermatch
 import scoring
 from itertools import combinations
 
@@ -39,7 +40,7 @@ dist_fun_map = {
 def match(paths, options = {}) : 
 	
 	# Get parameters
-	prune_fun = options.get("prune_fun", weightMatrix.pruneTreshold)
+	prune_fun = options.get("prune_fun", weightMatrix.pruneThreshold)
 	prune_limit = options.get("prune_limit", 3)
 	min_edges = options.get("min_edges", 1)
 	min_coherence = options.get("min_coherence", -1.0)
@@ -50,13 +51,13 @@ def match(paths, options = {}) :
 	cluster_prune_limit = options.get("cluster_prune_limit", 1.5)
 
 	# Get all feature points
-	indices, ks, ds = features.getFeatures(paths, keypoint_type = keypoint_type, descriptor_type = descriptor_type)
+	indices, ks, ds = features.getFeatures(paths, { "keypoint_type" : keypoint_type, "descriptor_type" : descriptor_type })
 
-	# Calculate weight matrix (hamming distances)
-	weights = weightMatrix.init(ds, descriptor_type)
-
-	# Get cluster weights
-	cluster_weights = prune_fun(weights, prune_limit)
+	# Get cluster weights (computed block by block when pruning by threshold)
+	if prune_fun == weightMatrix.pruneThreshold :
+		cluster_weights = weightMatrix.initPruned(ds, descriptor_type, prune_limit)
+	else :
+		cluster_weights = prune_fun(weightMatrix.init(ds, descriptor_type), prune_limit)
 
 	# Cluster graph
 	partitions = cluster(cluster_weights, indices, split_limit = split_limit, prune_limit = cluster_prune_limit, verbose=verbose)
@@ -73,48 +74,13 @@ def match(paths, options = {}) :
 
 
 def cluster(weights, indices, split_limit = 10, prune_limit = 3, verbose = False, rec_level = 0) :
-	partitions = louvain.cluster(weights, verbose=verbose)
-	if rec_level > 10 : return partitions
-	p_set = set(partitions)
-	
-	r = numpy.arange(0, weights.shape[0])
-	for p in p_set :
-		partition_mask = partitions == p
-		for i,j in combinations(set(indices),2) :
-			# Set up masks
-			row_mask = partition_mask & (indices == i)
-			col_mask = partition_mask & (indices == j)
-			index_row = r[row_mask]
-			index_col = r[col_mask]
-	
-			# Get weights
-			pij_edges = weights[row_mask][:,col_mask]
-			p_edges = weights[partition_mask][:,partition_mask]
-			nb_inter_edges = numpy.sum(pij_edges > 0)
-			if (numpy.sum(partition_mask) > split_limit) :
-				# Prune weights
-				p_edges_pruned = weightMatrix.pruneTreshold(p_edges, prune_limit)
-
-				# If there are no edges left, then skip
-				if numpy.sum(p_edges_pruned) == 0 : continue
-
-				# normalizing weights
-				p_max = numpy.max(p_edges_pruned)
-				p_min = numpy.min(p_edges_pruned[p_edges_pruned.nonzero()])
-				p_zero = p_edges_pruned == 0
-				p_edges_norm = (p_edges_pruned - p_min) / (p_max - p_min)
-				p_edges_norm[p_zero] = 0
-				
-				# cluster
-				p_partition = cluster(p_edges_norm, indices[partition_mask], split_limit, prune_limit, verbose, rec_level + 1)
-			
-				# Update partitioning
-				partitions[partition_mask] = p_partition + numpy.max(partitions) + 1
-	return partitions
+	""" Splits the graph into partitions (see clustermatch.cluster) """
+	return clustermatch.cluster(weights, indices, split_limit, prune_limit, verbose, rec_level)
 
 
 
 def getPartitionMatches(partitions, weights, indices, min_edges = 1, min_coherence = -1.0, verbose = False, ks = None, homography = None) :
+	""" weights can be a dense or a scipy.sparse matrix """
 
 	# index
 	index = numpy.arange(0, weights.shape[0])
@@ -122,7 +88,7 @@ def getPartitionMatches(partitions, weights, indices, min_edges = 1, min_coheren
 	for p in set(partitions) :
 
 		partition_mask = partitions == p
-		partition_weights = weights[partition_mask][:, partition_mask]
+		partition_weights = clustermatch.submatrix(weights, index[partition_mask])
 		for i,j in combinations(set(indices),2) :
 
 			# Set up masks
@@ -132,7 +98,7 @@ def getPartitionMatches(partitions, weights, indices, min_edges = 1, min_coheren
 			index_col = index[col_mask]
 
 			# Get weights
-			pij_edges = weights[row_mask][:,col_mask]
+			pij_edges = clustermatch.submatrix(weights, index_row, index_col)
 			c = getCoherence(partition_weights, partition_mask, indices, i, j)
 			nb_e = numpy.sum(pij_edges > 0)
 
@@ -164,16 +130,16 @@ def getUniqueness(row) :
 
 
 def getMatchPosition(i,j, keypoints) :
-	pos = features.getPositions([keypoints[i], keypoints[j]])
+	pos = features.getPositions(keypoints[[i, j]])
 	return (pos[0], pos[1])
 
 
 
 def getDistMat(keypoints) :
 	# Get positions
-	x_list,y_list = zip(*map(features.getPosition, keypoints))
-	x = numpy.array(x_list)
-	y = numpy.array(y_list)
+	positions = numpy.array(features.getPositions(keypoints))
+	x = positions[:,0]
+	y = positions[:,1]
 
 	# Calculate distances
 	x_outer = numpy.outer(x,x)
@@ -0,0 +1,71 @@
+"""
+Python module with a result type for the matchers. A match function used to
+be a closure that filtered the full list of matches on every call. A
+MatchResult keeps the matches sorted by the value the threshold is compared
+against, so a threshold is a binary search and the result is a slice of the
+sorted columns.
+"""
+
+####################################
+#                                  #
+#            Imports               #
+#                                  #
+####################################
+
+import numpy
+
+
+
+####################################
+#                                  #
+#             Classes              #
+#                                  #
+####################################
+
+
+class MatchResult(object) :
+    """ A set of matches stored as columns (e.g. positions, ratios, scores)
+        sorted by key. Calling the result with a threshold returns the columns
+        of all matches with key < threshold, just like the match_fun closures
+        returned by the matchers did. Matches with a key of nan are never returned
+    """
+
+    def __init__(self, columns, keys) :
+        keys = numpy.array(keys, dtype=numpy.float64)
+        keys[numpy.isnan(keys)] = numpy.inf
+
+        # A stable sort keeps matches with the same key in the order they were found
+        self.order = numpy.argsort(keys, kind="mergesort")
+        self.keys = keys[self.order]
+        self.columns = [numpy.asarray(c)[self.order] if len(c) > 0 else numpy.array([]) for c in columns]
+
+
+    def __call__(self, threshold) :
+        """ Returns a tuple of columns for the matches with key < threshold """
+        k = self.count(threshold)
+        if k == 0 : return tuple([] for c in self.columns)
+        return tuple(c[:k] for c in self.columns)
+
+
+    def __len__(self) :
+        return len(self.keys)
+
+
+    def count(self, threshold) :
+        """ Returns the amount of matches with key < threshold (for a list of thresholds too) """
+        return numpy.searchsorted(self.keys, threshold, side="left")
+
+
+    def sweep(self, thresholds, correct, nb_correspondences = None) :
+        """ Calculates precision and recall for every threshold in one pass
+            thresholds : List[Float] (the thresholds to evaluate)
+            correct : List[Boolean] (for every match in the order of self(numpy.inf), 
+                                     whether it is correct)
+            nb_correspondences : Int (the number of possible correct matches, needed for recall)
+        """
+        total = self.count(numpy.asarray(thresholds))
+        correct_cum = numpy.concatenate(([0], numpy.cumsum(numpy.asarray(correct, dtype=numpy.int64))))
+        nb_correct = correct_cum[numpy.minimum(total, len(correct))]
+        precision = nb_correct / numpy.maximum(total, 1).astype(numpy.float64)
+        recall = None if nb_correspondences == None else nb_correct / float(nb_correspondences)
+        return { "correct" : nb_correct, "total" : total, "precision" : precision, "recall" : recall }
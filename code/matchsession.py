@@ -0,0 +1,188 @@
+"""
+Python module for matching a stream of images against one reference image.
+The features and tree of the reference image are computed once and reused
+for every query, and the k nearest neighbours across both images are
+merged from the neighbours in each image, so no tree over both images is
+built. Matches are the same as mirrormatch.match([reference, query])
+"""
+
+####################################
+#                                  #
+#            Imports               #
+#                                  #
+####################################
+
+import features
+import mirrormatch
+import trees
+import numpy
+
+
+####################################
+#                                  #
+#             Classes              #
+#                                  #
+####################################
+
+
+class MatchSession(object) :
+    """ Matches query images against a fixed reference image with the ratio
+        semantics of features.match (the "ratio" option) and the filtering of
+        mirrormatch.match. Like there, options["filter_features"] are indices
+        into the features of the reference image followed by the query image
+        that are left out
+    """
+
+    def __init__(self, path, options = {}) :
+        self.options = dict(options)
+        self.tree_type = options.get("tree_type", "ball")
+        self.options["dist_metric"] = features.dist_map(options.get("descriptor_type", "SIFT"))
+
+        # Index the reference image (nothing is matched if it has no descriptors)
+        indices, self.keypoints, self.descriptors = features.getFeatures([path], self.options)
+        self.nb_reference = 0 if self.descriptors is None else len(self.descriptors)
+        if self.descriptors is not None :
+            keep = keepMask(self.nb_reference, self.options.get("filter_features", []), 0)
+            self.keypoints, self.descriptors = self.keypoints[keep], self.descriptors[keep]
+        if self.descriptors is None or len(self.descriptors) == 0 :
+            self.keypoints, self.descriptors, self.tree = [], [], None
+            self.positions = numpy.zeros((0, 2))
+            return
+        self.positions = numpy.array(features.getPositions(self.keypoints))
+        self.tree = trees.init(self.descriptors, self.tree_type, self.options)
+        self.within = knn(self.tree, self.descriptors, 3, len(self.descriptors))
+
+
+    def __call__(self, path) :
+        return self.match(path)
+
+
+    def match(self, path) :
+        """ Returns the MatchResult of mirrormatch.match([reference, path]) """
+        indices, ks, ds = features.getFeatures([path], self.options)
+        if ds is None : ks, ds = [], []
+        else :
+            keep = keepMask(len(ds), self.options.get("filter_features", []), self.nb_reference)
+            ks, ds = ks[keep], ds[keep]
+        match_data = self.matchDescriptors(ds)
+
+        indices = numpy.concatenate((numpy.zeros(len(self.descriptors), dtype=numpy.int32), numpy.ones(len(ds), dtype=numpy.int32)))
+        positions = numpy.concatenate((self.positions, numpy.array(features.getPositions(ks)).reshape(-1, 2)))
+        return mirrormatch.getMatchResult(match_data, indices, positions)
+
+
+    def matchDescriptors(self, D) :
+        """ Returns the matches of features.match on the descriptors of the
+            reference image followed by D, as a list of ((i, j), score, ratio)
+        """
+
+        # Default ratio
+        default_ratio       = { "proposed" : "target", "baseline" : "both" }
+
+        # Get options
+        proposed            = self.options.get("ratio", default_ratio)["proposed"]
+        baseline            = self.options.get("ratio", default_ratio)["baseline"]
+
+        if len(D) == 0 or self.tree is None : return []
+        n = len(self.descriptors)
+        tree = trees.init(D, self.tree_type, self.options)
+
+        # Nearest neighbours of both images in the image itself and in the other image
+        within = [self.within, knn(tree, D, 3, len(D), offset = n)]
+        target = [knn(tree, self.descriptors, 3, len(D), offset = n), knn(self.tree, D, 3, n)]
+        offsets = [0, n]
+
+        M_query = [(idx[:, :2], dist[:, :2]) for idx, dist in within]
+        M_target = [(idx[:, :2], dist[:, :2]) for idx, dist in target]
+        M_all = [merge(w, t, 3) for w, t in zip(within, target)]
+
+        # Produce matches across two different sets of neighbours
+        def dual(M_proposed, M_baseline, overlap) :
+            fst_proposed, fst_baseline = (int(overlap[0]), int(overlap[1]))
+            for offset, (idx_p, dist_p), (idx_b, dist_b) in zip(offsets, M_proposed, M_baseline) :
+                index_from = numpy.repeat(numpy.arange(len(idx_p)) + offset, idx_p.shape[1] - fst_proposed)
+                index_to = idx_p[:, fst_proposed:].ravel()
+                score = dist_p[:, fst_proposed:]
+                ratio = score / dist_b[:, fst_baseline][:, numpy.newaxis]
+                found = ((idx_p[:, fst_proposed:] >= 0) & numpy.isfinite(dist_b[:, fst_baseline])[:, numpy.newaxis]).ravel()
+                for match in zip(zip(index_from[found], index_to[found]), score.ravel()[found], ratio.ravel()[found]) :
+                    yield match
+
+        # Produce matches within the same set of neighbours
+        def single(M, overlap) :
+            fst, snd = (1, 2) if overlap else (0, 1)
+            for offset, (idx, dist) in zip(offsets, M) :
+                index_from = numpy.arange(len(idx)) + offset
+                found = (idx[:, fst] >= 0) & numpy.isfinite(dist[:, snd])
+                for match in zip(zip(index_from[found], idx[found, fst]), dist[found, fst], dist[found, fst] / dist[found, snd]) :
+                    yield match
+
+        # Mirror match
+        if proposed in ["both","all"] and baseline in ["both","all"] :
+            return list(single(M_all, overlap = True))
+
+        # Ratio match
+        elif proposed == "target" and baseline == "target" :
+            return list(single(M_target, overlap = False))
+
+        # query Strict
+        elif proposed == "target" and baseline == "query" :
+            return list(dual(M_target, M_query, overlap = (False, True)))
+
+        # query Both
+        elif proposed in ["both","all"] and baseline == "query" :
+            return list(dual(M_all, M_query, overlap = (True, True)))
+
+        # Ratio Ext
+        elif proposed in ["both","all"] and baseline == "target" :
+            return list(dual(M_all, M_target, overlap = (True, True)))
+
+        # Weird Match
+        elif proposed == "target" and baseline in ["both","all"] :
+            return list(dual(M_target, M_all, overlap = (False, 2)))
+
+        else :
+            raise Exception("Unknown ratio combination: proposed = '%s', baseline = '%s'" % (proposed, baseline))
+
+
+
+####################################
+#                                  #
+#           Functions              #
+#                                  #
+####################################
+
+
+def knn(query_fun, D, k, n, offset = 0) :
+    """ Returns the indices and distances of the k nearest neighbours of
+        every row in D as two arrays, using a query function of trees.init
+        over n descriptors. The indices are shifted by offset. When the tree
+        has fewer than k descriptors the missing neighbours get index -1 and
+        distance inf
+    """
+    idx = -1 * numpy.ones((len(D), k), dtype=numpy.int64)
+    dist = numpy.ones((len(D), k)) * numpy.inf
+    if min(k, n) > 0 :
+        found, found_dist = zip(*query_fun(D, min(k, n)))
+        idx[:, :min(k, n)] = numpy.array(found) + offset
+        dist[:, :min(k, n)] = found_dist
+    return idx, dist
+
+
+
+def keepMask(n, filter_features, offset) :
+    """ Returns a mask of the n features starting at offset that aren't in filter_features """
+    keep = numpy.ones(n, dtype = bool)
+    ff = numpy.asarray(filter_features, dtype = numpy.int64) - offset
+    keep[ff[(ff >= 0) & (ff < n)]] = False
+    return keep
+
+
+
+def merge(a, b, k) :
+    """ Merges two sets of nearest neighbours (idx, dist) and keeps the k nearest """
+    idx = numpy.hstack((a[0], b[0]))
+    dist = numpy.hstack((a[1], b[1]))
+    order = numpy.argsort(dist, axis = 1, kind = "mergesort")[:, :k]
+    rows = numpy.arange(len(idx))[:, numpy.newaxis]
+    return idx[rows, order], dist[rows, order]
@@ -13,6 +13,7 @@ Jonas Toft Arnfred, 2013-05-23
 
 import features
 import numpy
+from matchresult import MatchResult
 
 
 ####################################
@@ -25,22 +26,28 @@ import numpy
 
 def match(paths, options = {}) :
 
-    # Returns the position of a match
-    def matchPos(i,j) :
-        return (features.getPosition(ks[i]), features.getPosition(ks[j]))
-
     # Get options
     verbose             = options.get("match_verbose", False)
     filter_features     = options.get("filter_features", [])
 
     # Get all feature points
     indices, ks, ds = getFeatures(paths, filter_features, options)
+    positions = numpy.array(features.getPositions(ks))
 
     # Match
     match_data = features.match(ds, indices, options)
 
     if verbose : print("\n%i Matches found" % (len(match_data)))
 
+    return getMatchResult(match_data, indices, positions)
+
+
+
+def getMatchResult(match_data, indices, positions) :
+    """ Keeps the matches of features.match that are across images, once for
+        every pair of feature points, and returns them as a MatchResult
+    """
+
     # Find all matches
     def get_matches() :
         seen = set([])
@@ -79,13 +86,13 @@ def match(paths, options = {}) :
     # Collect all matches
     matches = list(get_matches())
 
-    # Define a function that given a threshold returns a set of matches
-    def match_fun(threshold) :
-        match_data = [(matchPos(i, j), s, u, (indices[i], indices[j]), (i,j)) for (i, j),s,u in matches if u < threshold]
-        if len(match_data) == 0 : return [], [], [], [], []
-        return zip(*match_data)
+    # Store the matches sorted by ratio so a threshold is a binary search
+    if len(matches) == 0 : return MatchResult([[], [], [], [], []], [])
+    pairs, scores, ratios = zip(*matches)
+    pairs = numpy.array(pairs)
+    columns = [positions[pairs], scores, ratios, indices[pairs], pairs]
 
-    return match_fun
+    return MatchResult(columns, ratios)
 
 
 
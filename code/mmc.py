@@ -13,8 +13,7 @@ Jonas Toft Arnfred, 2013-05-22
 import numpy
 import features
 import louvain
-import weightMatrix
-from itertools import combinations
+import clustermatch
 
 
 ####################################
@@ -27,10 +26,6 @@ from itertools import combinations
 def calcSIFTmatching(d_array_a, d_array_b, matching_th = None, options = {}) : 
 	
 	# Get parameters
-	prune_fun = options.get("prune_fun", weightMatrix.pruneThreshold)
-	prune_limit = options.get("prune_limit", 2.5)
-	keypoint_type = options.get("keypoint_type", "SIFT")
-	descriptor_type = options.get("descriptor_type", "SIFT")
 	verbose = options.get("verbose", False)
 	split_limit = options.get("split_limit", 50)
 	cluster_prune_limit = options.get("cluster_prune_limit", 1.5)
@@ -42,137 +37,22 @@ def calcSIFTmatching(d_array_a, d_array_b, matching_th = None, options = {}) :
 	ds = numpy.concatenate((d_array_a[:,:128], d_array_b[:,:128]))
 	indices = numpy.concatenate((numpy.zeros(d_array_a.shape[0]), numpy.ones(d_array_b.shape[0])))
 
-	# Calculate weight matrix
-	weights = weightMatrix.init(ds, descriptor_type)
-
 	# Get cluster weights
-	cluster_weights = prune_fun(weights, prune_limit)
+	weights, cluster_weights, top_weights = clustermatch.getClusterWeights(ds, options)
 
 	# Cluster graph
 	partitions = cluster(cluster_weights, indices, split_limit = split_limit, prune_limit = cluster_prune_limit, verbose=verbose)
 	if verbose : print("%i partitions" % len(set(partitions)))
 
-	matches = list(getPartitionMatches(partitions, cluster_weights, weights, indices, threshold))
+	matches = list(clustermatch.getPartitionMatches(partitions, cluster_weights, weights, indices, threshold, top_weights = top_weights))
 
 	return len(matches) / float(indices.shape[0])
 
 
 
-def getMatches(m, ind, threshold) :
-
-	def getMaxMatch(m) :
-		for i,row in enumerate(m) :
-			s = numpy.argsort(row)
-			u = row[s[-2]] / row[s[-1]]
-			if u < threshold : yield (i,s[-1])
-	
-	# Get best matches for rows and columns
-	matches = list(getMaxMatch(m))
-	
-	# Check that matches are both ways
-	matches = [(i,m) for i,m in matches if (m,i) in matches and ind[i] == 0 and ind[m] != 0]
-	return matches
-
-
-
 def cluster(weights, indices, split_limit = 10, prune_limit = 3, verbose = False, rec_level = 0) :
-	partitions = louvain.cluster(weights, verbose=verbose)
-	if rec_level > 10 : return partitions
-	p_set = set(partitions)
-	
-	r = numpy.arange(0, weights.shape[0])
-	for p in p_set :
-		partition_mask = partitions == p
-		for i,j in combinations(set(indices),2) :
-			# Set up masks
-			row_mask = partition_mask & (indices == i)
-			col_mask = partition_mask & (indices == j)
-			index_row = r[row_mask]
-			index_col = r[col_mask]
-	
-			# Get weights
-			pij_edges = weights[row_mask][:,col_mask]
-			p_edges = weights[partition_mask][:,partition_mask]
-			nb_inter_edges = numpy.sum(pij_edges > 0)
-			if (numpy.sum(partition_mask) > split_limit) :
-				# Prune weights
-				p_edges_pruned = weightMatrix.pruneThreshold(p_edges, prune_limit)
-
-				# If there are no edges left, then skip
-				if numpy.sum(p_edges_pruned) == 0 : continue
-
-				# normalizing weights
-				p_max = numpy.max(p_edges_pruned)
-				p_min = numpy.min(p_edges_pruned[p_edges_pruned.nonzero()])
-				p_zero = p_edges_pruned == 0
-				p_edges_norm = (p_edges_pruned - p_min) / (p_max - p_min)
-				p_edges_norm[p_zero] = 0
-				
-				# cluster
-				p_partition = cluster(p_edges_norm, indices[partition_mask], split_limit, prune_limit, verbose, rec_level + 1)
-			
-				# Update partitioning
-				partitions[partition_mask] = p_partition + numpy.max(partitions) + 1
-	return partitions
-
-
-def getPartitionMatches(partitions, weights, full_weights, indices, threshold, verbose = False, ks = None, homography = None) :
-
-	# index
-	index = numpy.arange(0, weights.shape[0])
-	# Get numpy array of indices
-	for p in set(partitions) :
-
-		partition_mask = partitions == p
-		partition_weights = weights[partition_mask][:, partition_mask]
-		for i,j in combinations(set(indices),2) :
-
-			# Set up masks
-			mask_row = partition_mask & (indices == i)
-			mask_col = partition_mask & (indices == j)
-			mask_both = mask_row | mask_col
-			index_row = index[mask_row]
-			index_col = index[mask_col]
-			index_both = index[mask_row | mask_col]
-
-			# Get weights
-			pij_edges = weights[mask_row][:,mask_col]
-			pij_edges_both = weights[mask_both][:,mask_both]
-			nb_e = numpy.sum(pij_edges > 0)
-
-			# If the cluster as only one edge going from one image to the other
-			if nb_e == 1 :
-				# Get weight
-				(m_i, m_j) = numpy.unravel_index(pij_edges.argmax(), pij_edges.shape)
-				w = pij_edges[m_i, m_j]
-				
-				# Get second largest row and col weight
-				sort_row = numpy.sort(full_weights[index_row[m_i],:])
-				sort_col = numpy.sort(full_weights[:,index_col[m_j]])
-				
-				# Test if the maximum match is the both for row and col
-				bothways_p = sort_row[-1] == sort_col[-1]
-				ratio_row = sort_row[-2] / w
-				ratio_col = sort_col[-2] / w
-
-				if bothways_p and (ratio_row < threshold and ratio_col < threshold) :
-					(p_i, p_j) = (index_row[m_i], index_col[m_j])
-					if verbose : 
-						distance = matchDistance(ks[p_i].pt, ks[p_j].pt, homography)
-						print("%4i\tEdges: %i\tDistance: %.2f" % (p, nb_e, distance))
-					yield (p_i, p_j)
-
-			# If there are several edges
-			elif nb_e >= 2 :
-
-				# Collect matches and check if they are beyond threshold
-				matches = getMatches(pij_edges_both, indices[mask_both], threshold)
-				for m_i,m in matches :
-					(p_i, p_j) = (index_both[m_i], index_both[m])
-					if verbose :
-						distance = matchDistance(ks[p_i].pt, ks[p_j].pt, homography)
-						print("%4i\tEdges: %i\tDistance: %.2f" % (p, nb_e, distance))
-					yield (p_i, p_j)
+	""" Splits the graph into partitions (see clustermatch.cluster) """
+	return clustermatch.cluster(weights, indices, split_limit, prune_limit, verbose, rec_level)
 
 
 def getCoherence(partition_weights, partition_mask, indices, i, j) :
@@ -192,16 +72,16 @@ def getUniqueness(row) :
 
 
 def getMatchPosition(i,j, keypoints) :
-	pos = features.getPositions([keypoints[i], keypoints[j]])
+	pos = features.getPositions(keypoints[[i, j]])
 	return (pos[0], pos[1])
 
 
 
 def getDistMat(keypoints) :
 	# Get positions
-	x_list,y_list = zip(*map(features.getPosition, keypoints))
-	x = numpy.array(x_list)
-	y = numpy.array(y_list)
+	positions = numpy.array(features.getPositions(keypoints))
+	x = positions[:,0]
+	y = positions[:,1]
 
 	# Calculate distances
 	x_outer = numpy.outer(x,x)
@@ -15,7 +15,6 @@ import fnmatch
 import features
 import display
 import louvain
-import weightMatrix
 import clustermatch
 import numpy
 import cv2
@@ -24,8 +23,7 @@ import pylab
 from string import ascii_uppercase, digits
 from os.path import isdir, dirname, exists
 import random
-from itertools import combinations, groupby, product
-from scipy.interpolate import griddata
+from itertools import combinations, groupby
 from scipy.misc import imresize
 
 
@@ -102,27 +100,21 @@ def getPartitions(paths, options = {}) :
     """
 
     # Get parameters
-    prune_limit = options.get("prune_limit", 2.5)
-    keypoint_type = options.get("keypoint_type", "SIFT")
-    descriptor_type = options.get("descriptor_type", "SIFT")
     verbose = options.get("verbose", False)
     split_limit = options.get("split_limit", 50)
     cluster_prune_limit = options.get("cluster_prune_limit", 1.5)
 
     # Get all feature points
-    indices, ks, ds = features.getFeatures(paths, keypoint_type = keypoint_type, descriptor_type = descriptor_type)
-
-    # Calculate weight matrix
-    weights = weightMatrix.init(ds, descriptor_type)
+    indices, ks, ds = features.getFeatures(paths, options)
 
     # Get cluster weights
-    cluster_weights = weightMatrix.pruneThreshold(weights, prune_limit)
+    weights, cluster_weights, top_weights = clustermatch.getClusterWeights(ds, options)
 
     # Cluster graph
     partitions = clustermatch.cluster(cluster_weights, indices, split_limit = split_limit, prune_limit = cluster_prune_limit, verbose=verbose)
     if verbose : print("%i partitions" % len(set(partitions)))
 
-    return indices, ks, lambda t : list(clustermatch.getPartitionMatches(partitions, cluster_weights, weights, indices, t))
+    return indices, ks, lambda t : list(clustermatch.getPartitionMatches(partitions, cluster_weights, weights, indices, t, top_weights = top_weights))
 
 
 
@@ -207,54 +199,49 @@ def getRandPath(size=6, chars=ascii_uppercase + digits) :
 
 
 def combine(im1, im2, h_1_2, scale = 0.5) :
-    """ Combining two images """
-    
-    # Utility function for calculating the transformation of a point with homography
-    def fromHom(p,h) :
-        crd = h.dot(numpy.array([p[0], p[1], 1]))
-        crd_norm = crd / crd[2]
-        return (crd_norm[0], crd_norm[1])
+    """ Combining two images. im1 is warped into the frame of im2 and im2 is
+        pasted on top where it is nonzero
+    """
 
     # Get image coordinates
     (im1_y, im1_x) = im1.shape
     (im2_y, im2_x) = im2.shape
 
     print(h_1_2)
-    
-    # Collect data points for the transformed image
-    im_data = numpy.zeros((im1.shape[0]*im1.shape[1],3))
-    for k,(x,y) in enumerate(product(range(0, im1_x), range(0, im1_y))) :
-        (x_new, y_new) = fromHom((x,y),h_1_2)
-        im_data[k,:] = numpy.array((x_new, y_new, im1[y,x]))
+
+    # Transform the corners of im1. Their bounding box holds the whole transformed image
+    corners = numpy.array([[0, 0, 1], [im1_x - 1, 0, 1], [0, im1_y - 1, 1], [im1_x - 1, im1_y - 1, 1]], dtype=numpy.float64)
+    corners_new = corners.dot(h_1_2.T)
+    corners_new = corners_new[:, :2] / corners_new[:, 2:]
 
     # Get max and min values
-    max_x = min(numpy.max(im_data[:,0])+1, 2000)
-    max_y = min(numpy.max(im_data[:,1])+1, 2000)
-    min_x = max(numpy.min(im_data[:,0]), -2000)
-    min_y = max(numpy.min(im_data[:,1]), -2000)
-
-    # Calculate padding for canvas
-    padding_min_x = max(min_x,0)
-    padding_max_x = max(im2_x - max_x, 0)
-    padding_min_y = max(min_y,0)
-    padding_max_y = max(im2_y - max_y, 0)
-
-    # Interpolate result
+    max_x = min(numpy.max(corners_new[:,0])+1, 2000)
+    max_y = min(numpy.max(corners_new[:,1])+1, 2000)
+    min_x = max(numpy.min(corners_new[:,0]), -2000)
+    min_y = max(numpy.min(corners_new[:,1]), -2000)
+
+    # The canvas covers both images and starts at a whole pixel
+    offset_x = int(numpy.ceil(max(-1*min_x,0)))
+    offset_y = int(numpy.ceil(max(-1*min_y,0)))
+    width = int(numpy.ceil(max(max_x, im2_x))) + offset_x
+    height = int(numpy.ceil(max(max_y, im2_y))) + offset_y
+
+    # Warp im1 onto the canvas by sampling it at the inverse transform of every canvas pixel
     print("max: (%i,%i), min: (%i,%i)" % (max_x, max_y, min_x, min_y))
-    print("Creating a grid of side: %i x %i" % (max_y+padding_max_y - min_y+padding_min_y, max_x+padding_max_x - min_x+padding_min_x))
-    grid_y, grid_x = numpy.mgrid[min_y-padding_min_y:max_y+padding_max_y, min_x-padding_min_x:max_x+padding_max_x]
-    im_interp = griddata(im_data[:,0:2], im_data[:,2], (grid_x, grid_y), method='linear', fill_value=0)
+    print("Creating a grid of side: %i x %i" % (height, width))
+    h_offset = numpy.identity(3)
+    h_offset[0,2] = offset_x
+    h_offset[1,2] = offset_y
+    im_interp = cv2.warpPerspective(im1.astype(numpy.float32), h_offset.dot(h_1_2), (width, height),
+                                    flags = cv2.INTER_LINEAR, borderMode = cv2.BORDER_CONSTANT, borderValue = 0)
 
     # Cut highlights
-    im_interp[im_interp > 255] = 255
-    im_interp[im_interp < 0] = 0
+    im_interp = numpy.clip(im_interp, 0, 255)
 
     # Fill in im2
-    offset_x = max(-1*min_x,0)
-    offset_y = max(-1*min_y,0)
-    for x, y in product(range(0, im2_x), range(0, im2_y)) :
-        if im2[y,x] > 0 :
-            im_interp[y + offset_y, x + offset_x] = im2[y,x]
+    canvas_2 = im_interp[offset_y:offset_y + im2_y, offset_x:offset_x + im2_x]
+    mask = im2[:canvas_2.shape[0], :canvas_2.shape[1]] > 0
+    canvas_2[mask] = im2[:canvas_2.shape[0], :canvas_2.shape[1]][mask]
 
     # Scale result
     im_r = imresize(im_interp, size=float(scale), interp='bicubic')
@@ -271,15 +258,8 @@ def combine(im1, im2, h_1_2, scale = 0.5) :
     h_s[1,1] = scale
 
     # Now calculate new_h1, new_h2
-    h_1_r = numpy.identity(3)
-    h_1_r[0,2] = -1*min_x
-    h_1_r[1,2] = -1*min_y
-    h_1_r = h_s.dot(h_1_r).dot(h_1_2)
-
-    h_2_r = numpy.identity(3)
-    h_2_r[0,2] = max(-1*min_x,0)
-    h_2_r[1,2] = max(-1*min_y,0)
-    h_2_r = h_s.dot(h_2_r)
+    h_1_r = h_s.dot(h_offset).dot(h_1_2)
+    h_2_r = h_s.dot(h_offset)
 
     return im_r, h_1_r, h_2_r, path
 
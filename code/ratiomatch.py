@@ -24,6 +24,7 @@ Jonas Toft Arnfred, 2013-07-17
 
 import features
 import numpy
+from matchresult import MatchResult
 
 
 ####################################
@@ -43,17 +44,15 @@ def match(paths, options = {}) :
     match_data = features.bfMatch(ds[indices == 0], ds[indices == 1])
 
     # Get all positions
-    (pos_im1, pos_im2) = (features.getPositions(ks[indices == 0]), features.getPositions(ks[indices == 1]))
+    (pos_im1, pos_im2) = (numpy.array(features.getPositions(ks[indices == 0])), numpy.array(features.getPositions(ks[indices == 1])))
 
-    # Define a function that given a threshold returns a set of matches
-    def match_fun(match_data, threshold) :
-        match_data = [(numpy.array((pos_im1[i], pos_im2[j])), s, u) for (i, j), s, u in match_data if u < threshold]
-        if len(match_data) == 0 : return [], [], []
-        matches, ratios, scores = zip(*match_data)
+    # Store the matches sorted by ratio so a threshold is a binary search
+    if len(match_data) == 0 or match_data[0] == None : return MatchResult([[], [], []], [])
+    pairs, scores, ratios = zip(*match_data)
+    pairs = numpy.array(pairs)
+    positions = numpy.concatenate((pos_im1[pairs[:,0]][:, None], pos_im2[pairs[:,1]][:, None]), axis = 1)
 
-        return matches, ratios, scores
-
-    return lambda t : match_fun(match_data, t)
+    return MatchResult([positions, scores, ratios], ratios)
 
 
 def getMatchSet(paths, options = {}) :
@@ -172,15 +172,11 @@ def scoreImages(paths,
 def getPartitionDeviation(partition_mask, image_mask, kpts) :
 	
 	def getSD(pos) :
-		ps = [(p[0],p[1]) for p in pos]
-		(xs, ys) = zip(*ps)
-		return numpy.sqrt((numpy.var(xs) + numpy.var(ys)) / 2.0)
+		return numpy.sqrt((numpy.var(pos[:,0]) + numpy.var(pos[:,1])) / 2.0)
 	
-	kpt_array = numpy.array(kpts)
-	im0_kpts = kpt_array[partition_mask & image_mask[0]]
-	im1_kpts = kpt_array[partition_mask & image_mask[1]]
-	pos0 = features.getPositions(im0_kpts)
-	pos1 = features.getPositions(im1_kpts)
+	positions = numpy.array(features.getPositions(numpy.array(kpts)))
+	pos0 = positions[partition_mask & image_mask[0]]
+	pos1 = positions[partition_mask & image_mask[1]]
 	sd0 = getSD(pos0)
 	sd1 = getSD(pos1)
 	return sd0,sd1
@@ -18,8 +18,11 @@ Jonas Toft Arnfred, 2013-07-03
 import features
 import display
 import numpy
+import scipy.sparse
+import scipy.sparse.linalg
 import itertools
 import ratiomatch
+from matchresult import MatchResult
 
 
 ####################################
@@ -37,18 +40,19 @@ def match(paths, options ={}) :
     sigma = options.get("affinity", 50)
     keep_ratio = options.get("keep_ratio", 0.5)
     verbose = options.get("verbose", False)
+    kernel = options.get("affinity_kernel", None)
+    sparse = options.get("affinity_sparse", False)
 
     matches, ratios, scores = matching_fun(paths, options)
     nb_matches = len(matches) * keep_ratio
     if (nb_matches < 1) : 
-        return lambda t : [], [], []
+        return MatchResult([[], [], []], [])
 
     # Get affinity matrix
-    M = affinity_matrix(matches, scores, affinity_fun, sigma)
+    M = affinity_matrix(matches, scores, affinity_fun, sigma, kernel, sparse)
 
     # Get eigenvectors
-    eigvals, eigvecs = numpy.linalg.eigh(M)
-    x_star = eigvecs[:, eigvals.argsort()[-1]]
+    x_star = principal_eigenvector(M, warm_start(scores), options)
 
     # For some reason I get an all-negative eigenvector at times. I'm just making sure it's positive here
     if x_star[0] < 0 : 
@@ -63,23 +67,9 @@ def match(paths, options ={}) :
         images = map(features.loadImage, paths)
         display.matchPoints(images[0], images[1], best_m)
         print("Best %i matches picked using geometric constraints" % nb_matches)
-        print("The score of x_star is: %.2f" % (x_star.T.dot(M).dot(x_star)))
+        print("The score of x_star is: %.2f" % (M.dot(x_star).dot(x_star)))
 
-
-    def match_fun(threshold) :
-        """ Given a threshold we return a list of matches """
-
-        match_data = [(pos, u, s) for (pos, u, s) 
-                in zip(best_m, best_ratios, best_scores) if u < threshold]
-
-        if len(match_data) == 0 : 
-            return [], [], []
-
-        matches, ratios, scores = zip(*match_data)
-
-        return matches, ratios, scores
-
-    return match_fun
+    return MatchResult([best_m, best_ratios, best_scores], best_ratios)
 
 
 def matchAlt(paths, options = {}) :
@@ -87,6 +77,8 @@ def matchAlt(paths, options = {}) :
     affinity_fun = options.get("affinity", affinity_simple)
     matching_fun = options.get("match_fun", ratiomatch.getMatchSet)
     sigma = options.get("affinity", 50)
+    kernel = options.get("affinity_kernel", None)
+    sparse = options.get("affinity_sparse", False)
 
     matches, scores, ratios = matching_fun(paths, options)
 
@@ -94,11 +86,10 @@ def matchAlt(paths, options = {}) :
     if len(matches) > 0 :
 
         # Get affinity matrix
-        M = affinity_matrix(matches, scores, affinity_fun, sigma)
+        M = affinity_matrix(matches, scores, affinity_fun, sigma, kernel, sparse)
 
         # Get eigenvectors
-        eigvals, eigvecs = numpy.linalg.eigh(M)
-        x_star = eigvecs[:, eigvals.argsort()[-1]]
+        x_star = principal_eigenvector(M, warm_start(scores), options)
 
         # For some reason I get an all-negative eigenvector at times. 
         # I'm just making sure it's positive here
@@ -123,9 +114,110 @@ def matchAlt(paths, options = {}) :
 
 
 
+def principal_eigenvector(M, x_0 = None, options = {}) :
+    """ Returns the eigenvector of the largest eigenvalue of M (dense or sparse)
+        x_0 : numpy.ndarray (start vector for the iterative solvers)
+        options : eigen_solver ("dense", "power" or "lanczos", by default
+                  lanczos for sparse and dense for dense matrices),
+                  eigen_tolerance, eigen_max_iter
+    """
+
+    # Get options
+    solver = options.get("eigen_solver", "lanczos" if scipy.sparse.issparse(M) else "dense")
+    tolerance = options.get("eigen_tolerance", 1e-8)
+    max_iter = options.get("eigen_max_iter", 1000)
+
+    # eigsh needs at least 3 rows
+    if solver == "lanczos" and M.shape[0] > 2 :
+        eigvals, eigvecs = scipy.sparse.linalg.eigsh(M, k = 1, which = "LA", v0 = x_0, tol = tolerance, maxiter = max_iter)
+        return eigvecs[:, 0]
+    elif solver == "power" :
+        return power_iteration(M, x_0, tolerance, max_iter)
+    else :
+        M = M.toarray() if scipy.sparse.issparse(M) else M
+        eigvals, eigvecs = numpy.linalg.eigh(M)
+        return eigvecs[:, eigvals.argsort()[-1]]
+
+
+
+def power_iteration(M, x_0 = None, tolerance = 1e-8, max_iter = 1000) :
+    """ Finds the principal eigenvector of a non-negative matrix by
+        multiplying and normalizing a start vector until it changes by less
+        than tolerance
+    """
+    x = numpy.ones(M.shape[0]) if x_0 is None else numpy.array(x_0, dtype=numpy.float64)
+    x = x / numpy.linalg.norm(x)
+    for i in range(max_iter) :
+        x_next = M.dot(x)
+        norm = numpy.linalg.norm(x_next)
+        if norm == 0 : return x
+        x_next = x_next / norm
+        if numpy.linalg.norm(x_next - x) < tolerance : return x_next
+        x = x_next
+    return x
+
+
+
+def warm_start(scores) :
+    """ Start vector for the iterative solvers with more weight on matches
+        with a low score, like the diagonal of the affinity matrix
+    """
+    scores = numpy.asarray(scores, dtype=numpy.float64)
+    if len(scores) == 0 or numpy.max(scores) <= 0 : return numpy.ones(len(scores))
+    return 1 - (scores / numpy.max(scores)) + 1e-3
+
+
+
 # Fill in the affinity matrix
-def affinity_matrix(matches, scores, affinity_fun, sigma) :
-    """ Fill in affinity matrix """
+def affinity_matrix(matches, scores, affinity_fun, sigma, kernel = None, sparse = False, block_size = 1000) :
+    """ Fill in affinity matrix. The affinities are calculated with a
+        vectorized kernel (see kernel_simple) a block of rows at a time. If no
+        kernel is given, the kernel registered for affinity_fun in kernels is
+        used, and for other affinity functions every pair is evaluated in
+        python. With sparse = True a scipy.sparse matrix is returned with
+        pairs whose distances differ by 3*sigma or more left out
+    """
+    kernel = kernels.get(affinity_fun, None) if kernel == None else kernel
+    if kernel == None : 
+        return affinity_matrix_loop(matches, scores, affinity_fun, sigma)
+
+    matches = numpy.asarray(matches, dtype=numpy.float64)
+    scores = numpy.asarray(scores, dtype=numpy.float64)
+    n = len(matches)
+    if n == 0 : return scipy.sparse.csr_matrix((0, 0)) if sparse else numpy.zeros((0, 0))
+    diagonal = 4.5*(1 - (scores / numpy.max(scores)))
+
+    m = numpy.zeros((n, n)) if not sparse else None
+    rows, cols, values = [], [], []
+    for i in range(0, n, block_size) :
+        # Distances between the points of the matches in each image
+        d_0 = numpy.sqrt(((matches[i:i+block_size, numpy.newaxis, 0] - matches[numpy.newaxis, :, 0])**2).sum(axis=2))
+        d_1 = numpy.sqrt(((matches[i:i+block_size, numpy.newaxis, 1] - matches[numpy.newaxis, :, 1])**2).sum(axis=2))
+        block = kernel(d_0, d_1, sigma)
+
+        # Set diagonal
+        r = numpy.arange(len(block))
+        block[r, r + i] = diagonal[i:i+block_size]
+
+        if sparse :
+            keep = numpy.abs(d_0 - d_1) < 3*sigma
+            keep[r, r + i] = True
+            keep &= block != 0
+            block_rows, block_cols = keep.nonzero()
+            rows.append(block_rows + i)
+            cols.append(block_cols)
+            values.append(block[keep])
+        else :
+            m[i:i+block_size] = block
+
+    if sparse : 
+        return scipy.sparse.coo_matrix((numpy.concatenate(values), (numpy.concatenate(rows), numpy.concatenate(cols))), shape=(n, n)).tocsr()
+    return m
+
+
+
+def affinity_matrix_loop(matches, scores, affinity_fun, sigma) :
+    """ Fill in affinity matrix evaluating affinity_fun for every pair """
     m = numpy.zeros((len(matches), len(matches)))
     for i, m_1 in enumerate(matches) :
         for j, m_2 in enumerate(matches) :
@@ -146,3 +238,18 @@ def affinity_simple(m_1, m_2, sigma) :
         return m_ab
     else :
         return 0.0
+
+
+
+# Vectorized affinity kernel
+def kernel_simple(d_0, d_1, sigma) :
+    """ affinity_simple for arrays of distances between the points in the
+        first (d_0) and second (d_1) image
+    """
+    m_ab = 4.5 - ((d_0 - d_1) ** 2) / (2*(sigma**2))
+    m_ab[numpy.abs(d_0 - d_1) >= 3*sigma] = 0.0
+    return m_ab
+
+
+# Vectorized kernels to use in place of pairwise affinity functions
+kernels = { affinity_simple : kernel_simple }
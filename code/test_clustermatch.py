@@ -0,0 +1,155 @@
+"""
+Tests for clustermatch. The edge based getPartitionMatches is compared to a
+reference implementation that loops over partitions and image pairs.
+"""
+
+####################################
+#                                  #
+#            Imports               #
+#                                  #
+####################################
+
+import numpy
+import scipy.sparse
+import features
+import clustermatch
+from itertools import combinations
+
+
+####################################
+#                                  #
+#           Functions              #
+#                                  #
+####################################
+
+
+def getPartitionMatchesLoop(partitions, weights, full_weights, indices, threshold, verbose = False, ks = None, homography = None, with_keys = False) :
+    """ Reference implementation of clustermatch.getPartitionMatches """
+
+    # index
+    index = numpy.arange(0, weights.shape[0])
+    # Get numpy array of indices
+    for p in set(partitions) :
+
+        partition_mask = partitions == p
+        for i,j in combinations(set(indices),2) :
+
+            # Set up masks
+            mask_row = partition_mask & (indices == i)
+            mask_col = partition_mask & (indices == j)
+            mask_both = mask_row | mask_col
+            index_row = index[mask_row]
+            index_col = index[mask_col]
+            index_both = index[mask_row | mask_col]
+
+            # Get weights
+            pij_edges = weights[mask_row][:,mask_col]
+            pij_edges_both = weights[mask_both][:,mask_both]
+            nb_e = numpy.sum(pij_edges > 0)
+
+            # If the cluster as only one edge going from one image to the other
+            if nb_e == 1 :
+                # Get weight
+                (m_i, m_j) = numpy.unravel_index(pij_edges.argmax(), pij_edges.shape)
+                w = pij_edges[m_i, m_j]
+
+                # Get second largest row and col weight
+                sort_row = numpy.sort(full_weights[index_row[m_i],:])
+                sort_col = numpy.sort(full_weights[:,index_col[m_j]])
+
+                # Test if the maximum match is the both for row and col
+                bothways_p = sort_row[-1] == sort_col[-1]
+                ratio_row = sort_row[-2] / w
+                ratio_col = sort_col[-2] / w
+
+                if bothways_p and (ratio_row < threshold and ratio_col < threshold) :
+                    (p_i, p_j) = (index_row[m_i], index_col[m_j])
+                    if verbose :
+                        distance = clustermatch.matchDistance(features.getPosition(ks[p_i]), features.getPosition(ks[p_j]), homography)
+                        print("%4i\tEdges: %i\tDistance: %.2f" % (p, nb_e, distance))
+                    if with_keys : yield ((p_i, p_j), ratio_row, w, max(ratio_row, ratio_col))
+                    else : yield ((p_i, p_j), ratio_row, w)
+
+            # If there are several edges
+            elif nb_e >= 2 :
+
+                # Collect matches and check if they are beyond threshold
+                matches, ratios, scores = clustermatch.getMatches(pij_edges_both, indices[mask_both], threshold)
+                for (m_i,m),u,s in zip(matches, ratios, scores) :
+                    (p_i, p_j) = (index_both[m_i], index_both[m])
+                    if verbose :
+                        distance = clustermatch.matchDistance(features.getPosition(ks[p_i]), features.getPosition(ks[p_j]), homography)
+                        print("%4i\tEdges: %i\tDistance: %.2f" % (p, nb_e, distance))
+                    if with_keys :
+                        # The reverse match (m, m_i) has to be below the threshold too
+                        row_sort = numpy.sort(pij_edges_both[m])
+                        yield ((p_i, p_j), u, s, max(u, row_sort[-2] / float(row_sort[-1])))
+                    else : yield ((p_i, p_j),u,s)
+
+
+
+def getGraph(seed = 0, nb_images = 3, nb_features = 40, nb_partitions = 8) :
+    """ Returns a random symmetric weight matrix with its pruned version,
+        partitions, image indices and keypoint table
+    """
+    random = numpy.random.RandomState(seed)
+    n = nb_images * nb_features
+    full_weights = random.rand(n, n)
+    full_weights = (full_weights + full_weights.T) / 2
+    full_weights[numpy.diag_indices(n)] = 0
+    partitions = random.randint(0, nb_partitions, n)
+
+    # Plant best matches alone in a partition of their own
+    for k in range(3) :
+        p_i, p_j = k, nb_features + k
+        full_weights[p_i, p_j] = full_weights[p_j, p_i] = 1.0 + 0.1 * k
+        partitions[[p_i, p_j]] = nb_partitions + k
+
+    weights = full_weights * (full_weights > 0.7)
+    indices = numpy.repeat(numpy.arange(nb_images), nb_features)
+    ks = numpy.zeros(n, dtype = features.keypoint_dtype)
+    ks["x"], ks["y"] = random.rand(2, n) * 100
+    return full_weights, weights, partitions, indices, ks
+
+
+
+def assertSameMatches(found, expected) :
+    assert len(found) == len(expected)
+    for f, e in zip(found, expected) :
+        assert tuple(f[0]) == tuple(e[0])
+        numpy.testing.assert_allclose(f[1:], e[1:])
+
+
+
+def test_partition_matches() :
+    full_weights, weights, partitions, indices, ks = getGraph()
+    for threshold in [0.8, 0.95, numpy.inf] :
+        for with_keys in [False, True] :
+            expected = list(getPartitionMatchesLoop(partitions, weights, full_weights, indices, threshold, with_keys = with_keys))
+            found = list(clustermatch.getPartitionMatches(partitions, weights, full_weights, indices, threshold, with_keys = with_keys))
+            assert len(expected) > 0
+            assertSameMatches(found, expected)
+
+
+
+def test_partition_matches_sparse() :
+    full_weights, weights, partitions, indices, ks = getGraph(seed = 1)
+    top_weights = numpy.sort(full_weights, axis = 1)[:, -2:]
+    expected = list(getPartitionMatchesLoop(partitions, weights, full_weights, indices, numpy.inf, with_keys = True))
+    found = list(clustermatch.getPartitionMatches(partitions, scipy.sparse.csr_matrix(weights), None, indices, numpy.inf, with_keys = True, top_weights = top_weights))
+    assertSameMatches(found, expected)
+
+
+
+def test_partition_matches_verbose(capsys) :
+    full_weights, weights, partitions, indices, ks = getGraph(seed = 2)
+    homography = numpy.array([[1.0, 0.1, 5.0], [0.0, 1.0, -3.0], [0.0, 0.0, 1.0]])
+
+    expected = list(getPartitionMatchesLoop(partitions, weights, full_weights, indices, 0.95, True, ks, homography))
+    expected_output = capsys.readouterr()[0]
+    found = list(clustermatch.getPartitionMatches(partitions, weights, full_weights, indices, 0.95, True, ks, homography))
+    found_output = capsys.readouterr()[0]
+
+    assertSameMatches(found, expected)
+    assert len(expected_output) > 0
+    assert found_output == expected_output
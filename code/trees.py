@@ -2,7 +2,13 @@
 Python module to provide a wrapper for a few tree types
 """
 from sklearn.neighbors.ball_tree import BallTree
+from multiprocessing.pool import ThreadPool
+import numpy
 import pyflann
+import time
+
+# Number of set bits in every possible byte
+popcount_table = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.uint8)
 
 # Ball tree
 def init(data, tree_type, options = {}) :
@@ -10,6 +16,8 @@ def init(data, tree_type, options = {}) :
         return ball_init(data, options)
     elif tree_type == "flann" :
         return flann_init(data, options)
+    elif tree_type == "hamming" :
+        return hamming_init(data, options)
 
 
 def ball_init(data, options) :
@@ -18,14 +26,34 @@ def ball_init(data, options) :
     leaf_size           = options.get("leaf_size", 10) 
     dist_metric         = options.get("dist_metric", "minkowski") 
     verbose             = options.get("verbose", False)
+    workers             = options.get("query_workers", 1)
+    chunksize           = options.get("query_chunksize", 1000)
     
     # Construct main ball tree
     tree = BallTree(data, leaf_size=leaf_size, metric=dist_metric)
 
+    def query_chunk(D, k) :
+        dist, idx = tree.query(D, k = k)
+        return idx, dist
+
     def query(D, k) :
         if verbose : print("."),
-        result = [tree.query(d, k = k) for d in D]
-        return [(i[0], d[0]) for d, i in result]
+        if len(D) == 0 : return []
+
+        # Query all descriptors at once, or in chunks spread over a pool of threads
+        if workers > 1 and len(D) > chunksize :
+            chunks = [D[i:i+chunksize] for i in range(0, len(D), chunksize)]
+            pool = ThreadPool(workers)
+            try :
+                result = pool.map(lambda c : query_chunk(c, k), chunks)
+            finally :
+                pool.close()
+                pool.join()
+            idx, dist = (numpy.concatenate([i for i, d in result]), numpy.concatenate([d for i, d in result]))
+        else :
+            idx, dist = query_chunk(D, k)
+
+        return zip(idx, dist)
 
     return query
 
@@ -46,3 +74,85 @@ def flann_init(data, options) :
         return [(i, d) for i, d in zip(idx, dist)]
 
     return query
+
+
+def hamming_init(data, options) :
+    """ Exhaustive k nearest neighbour search in hamming space for packed 
+        binary descriptors (ORB, BRIEF, BRISK, FREAK) as returned by opencv.
+        Distances are the number of differing bits
+    """
+
+    # Get options
+    verbose             = options.get("verbose", False)
+    chunksize           = options.get("query_chunksize", 1000)
+
+    data = numpy.ascontiguousarray(data, dtype=numpy.uint8)
+    rows = numpy.arange(chunksize)[:, numpy.newaxis]
+
+    def query_chunk(D, k) :
+        dist = hamming_dist(D, data)
+        # Find the k smallest distances per row and sort them by distance, then index
+        idx = numpy.argpartition(dist, k - 1, axis=1)[:, :k] if k < dist.shape[1] else numpy.tile(numpy.arange(dist.shape[1]), (len(D), 1))
+        d = dist[rows[:len(D)], idx]
+        order = numpy.lexsort((idx, d))
+        return idx[rows[:len(D)], order], d[rows[:len(D)], order]
+
+    def query(D, k) :
+        if verbose : print("."),
+        if len(D) == 0 : return []
+        D = numpy.ascontiguousarray(D, dtype=numpy.uint8)
+        result = [query_chunk(D[i:i+chunksize], k) for i in range(0, len(D), chunksize)]
+        idx = numpy.concatenate([i for i, d in result])
+        dist = numpy.concatenate([d for i, d in result]).astype(numpy.float64)
+        return zip(idx, dist)
+
+    return query
+
+
+def hamming_dist(A, B, block_size = 2**24) :
+    """ Returns a matrix of size len(A) x len(B) with the number of bits that 
+        differ between every row of A and every row of B, where A and B are 
+        packed binary descriptors. The xor is done on 64 bit words when the 
+        descriptor length allows it and in blocks of at most block_size bytes
+    """
+    A = numpy.ascontiguousarray(A, dtype=numpy.uint8)
+    B = numpy.ascontiguousarray(B, dtype=numpy.uint8)
+    result = numpy.empty((A.shape[0], B.shape[0]), dtype=numpy.uint16)
+    if A.shape[0] == 0 or B.shape[0] == 0 : return result
+
+    # Use 64 bit words if possible
+    if A.shape[1] % 8 == 0 :
+        A, B = (A.view(numpy.uint64), B.view(numpy.uint64))
+
+    step = max(1, block_size / max(1, B.nbytes))
+    for i in range(0, A.shape[0], step) :
+        xor = numpy.bitwise_xor(A[i:i+step, numpy.newaxis, :], B[numpy.newaxis, :, :])
+        result[i:i+step] = popcount_table[xor.view(numpy.uint8)].sum(axis=2, dtype=numpy.uint16)
+    return result
+
+
+def benchmark(data, k = 3, options = {}) :
+    """ Times the batched ball tree query against querying one descriptor at a 
+        time, which is how ball_init used to work. Returns the time in seconds
+        for each and whether they found the same neighbours
+        data : numpy.ndarray (descriptors, e.g. from features.getFeatures)
+        k : Int (number of neighbours)
+        options : Dict (same options as ball_init)
+    """
+    leaf_size           = options.get("leaf_size", 10) 
+    dist_metric         = options.get("dist_metric", "minkowski") 
+
+    # One query per descriptor
+    start = time.time()
+    tree = BallTree(data, leaf_size=leaf_size, metric=dist_metric)
+    single = [tree.query(data[i:i+1], k = k) for i in range(len(data))]
+    single = [(i[0], d[0]) for d, i in single]
+    time_single = time.time() - start
+
+    # Batched query
+    start = time.time()
+    batched = ball_init(data, options)(data, k)
+    time_batched = time.time() - start
+
+    same = all((numpy.all(i_s == i_b) and numpy.allclose(d_s, d_b)) for (i_s, d_s), (i_b, d_b) in zip(single, batched))
+    return { "single" : time_single, "batched" : time_batched, "same" : same }
@@ -21,6 +21,50 @@ import mirrormatch
 import colors
 import random
 import pylab
+import cPickle
+import json
+import multiprocessing
+import hashlib
+import collections
+
+# Calibration points per (image set, angle, camera position, pattern position)
+# and fundamental matrices per (image set, angles, camera positions, scale).
+# Filled as they are computed, or all at once by load_calibration
+calibration_cache = { "points" : {}, "F" : {}, "loaded" : set([]) }
+
+# Keypoint tables and descriptors of the turntable images per feature
+# configuration. Used as options["feature_store"] by default, so the ground
+# truth, the match functions and the match distances share the features.
+# Only the most recently used views are kept
+view_store_size = 64
+
+class ViewStore(object) :
+    """ Dict like store that keeps the size most recently used entries """
+
+    def __init__(self, size) :
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def __len__(self) :
+        return len(self.entries)
+
+    def __contains__(self, key) :
+        return key in self.entries
+
+    def __getitem__(self, key) :
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value) :
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size : self.entries.popitem(last = False)
+
+    def clear(self) :
+        self.entries.clear()
+
+view_store = ViewStore(view_store_size)
 
 ####################################
 #                                  #
@@ -38,70 +82,304 @@ def evaluate(match_fun, angles, object_type, thresholds, ground_truth_data = Non
         match_count : List[Int] (List of the amount of possible matches for each feature point)
         options : Dict (Set of parameters for matching etc)
     """
+    results = [evaluate_lighting(match_fun, angles, object_type, i, thresholds, ground_truth_data, options) for i in range(3)]
+    correct = [sum(c) for c in zip(*[r["correct"] for r in results])]
+    total = [sum(t) for t in zip(*[r["total"] for r in results])]
+    return { "correct" : correct, "total" : total }
+
+
+
+def evaluate_lighting(match_fun, angles, object_type, lightning_index, thresholds, ground_truth_data = None, options = {}) :
+    """ Returns number of correct and total matches of match_fun on object in one lighting condition:
+        lightning_index : Int (0, 1 or 2)
+        See evaluate for the other arguments
+    """
+
+    # Work on a copy so the options of the caller aren't changed
+    options = dict(options)
 
     # Get distance_threshold
     distance_threshold      = options.get("distance_threshold", 5)
     verbose                 = options.get("evaluate_verbose", False)
+    calibration_path        = options.get("calibration_cache", None)
+
+    # Load fundamental matrices computed beforehand
+    if calibration_path != None : load_calibration(calibration_path)
 
     # Get paths to the three images
-    def get_path(i) : return {
+    i = lightning_index
+    paths = {
             "A" : get_turntable_path(object_type, angles[0] + i*360, "Bottom"),
             "B" : get_turntable_path(object_type, angles[0] + i*360, "Top"),
             "C" : get_turntable_path(object_type, angles[1] + i*360, "Bottom")
     }
 
-    # Get paths
-    def get_matches(i) :
-        # Are we weeding out feature that can't be verified by ground truth?
-        options["filter_features"] = [] if ground_truth_data == None else ground_truth_data["filter_features"][i]
-
-        # Collect matches
-        paths = get_path(i)
-        return match_fun([paths["A"], paths["C"]], options = options)(1.0)
+    # Are we weeding out feature that can't be verified by ground truth?
+    options["filter_features"] = [] if ground_truth_data == None else ground_truth_data["filter_features"][i]
 
+    # Share features with the ground truth and match distances
+    options.setdefault("feature_store", view_store)
 
     # Get match results
-    matches = [get_matches(i) for i in range(3)]
-    positions = [m[0] for m in matches]
-    ratios = numpy.concatenate([m[2] for m in matches])
+    matches = match_fun([paths["A"], paths["C"]], options = options)(1.0)
+    ratios = numpy.asarray(matches[2])
 
     if verbose :
-        nb_matches = sum([len(m[0]) for m in matches])
-        print("Found %i matches for angles (%i, %i) and object type '%s'" % (nb_matches, angles[0], angles[1], object_type))
+        print("Found %i matches for angles (%i, %i), lighting %i and object type '%s'" % (len(matches[0]), angles[0], angles[1], i, object_type))
 
     # Get ground trouth
-    distances = numpy.concatenate([match_distances(m[0], angles, object_type, distance_threshold) for m in matches])
+    distances = numpy.asarray(match_distances(matches[0], angles, object_type, distance_threshold, i, options))
 
     if verbose :
         print("Found %i distances" % (len(distances)))
 
     # Collect precision per ratio_threshold
-    def get_count(t, dt) : return len([1 for d,r in zip(distances, ratios) if r <= t and d < dt])
+    def get_count(t, dt) : return int(numpy.sum((ratios <= t) & (distances < dt)))
     correct = [get_count(t, distance_threshold) for t in thresholds]
     total = [get_count(t, 9999999) for t in thresholds]
     return { "correct" : correct, "total" : total }
 
 
 
-def evaluate_objects(match_fun, angles, object_types, thresholds, ground_truth_data, options = {}) :
+def evaluate_objects(match_fun, angles, object_types, thresholds, ground_truth_data, options = {}, matcher_name = None) :
     """ Returns number of correct and total matches of match_fun on objects:
         match_fun : Function (Function that takes a list of paths and returns matches)
         angles : (Int, Int) (two angles in degrees. Must be divisible by 5)
         object_types : List[String] (the objects pictured on the turntable)
         thresholds : List[Float] (list of ratio thresholds)
-        options : Dict (Set of parameters for matching etc)
+        options : Dict (Set of parameters for matching etc). The objects are
+                  evaluated in parallel with options["evaluate_workers"] > 1
+        matcher_name : String (name of the results in options["results_path"].
+                       Defaults to the module and name of match_fun)
     """
-    # Get correct and total matches for different thresholds at current angle_increment
-    def get_results(object_type) :
-        gt = None if ground_truth_data == None else ground_truth_data[object_type]
-        return evaluate(match_fun, angles, object_type, thresholds, gt, options)
+    angles = tuple(angles)
+    name = matcher_name if matcher_name != None else get_matcher_name(match_fun)
+    gt = None if ground_truth_data == None else { angles : ground_truth_data }
+    records = run_experiments({ name : match_fun }, [angles], object_types, thresholds, gt, options)
+    failed = [r for r in records if "error" in r]
+    if len(failed) > 0 :
+        raise Exception("%i of %i experiments failed: %s" % (len(failed), len(records), "; ".join(r["error"] for r in failed)))
+    return collect_results(records, object_types, thresholds, options, gt != None)[name][angles]
 
 
-    results = [get_results(o) for o in object_types]
-    correct =  { o : r["correct"] for r,o in zip(results, object_types) }
-    total =  { o : r["total"] for r,o in zip(results, object_types) }
 
-    return { "correct" : correct, "total" : total }
+def get_matcher_name(match_fun) :
+    """ Returns a name like "mirrormatch.match" for a match function """
+    return "%s.%s" % (getattr(match_fun, "__module__", None), getattr(match_fun, "__name__", type(match_fun).__name__))
+
+
+
+####################################
+#                                  #
+#        Experiment Runner         #
+#                                  #
+####################################
+
+
+# The matchers, ground truth and options of the experiments being run. The
+# worker processes inherit it when they are forked, so match functions that
+# can't be pickled can still be used, and calibration and feature data
+# loaded beforehand is shared with them
+shared_experiment = {}
+
+def run_experiments(matchers, angle_pairs, object_types, thresholds, ground_truth_data = None, options = {}) :
+    """ Evaluates every matcher on every object, angle pair and lighting condition:
+        matchers : Dict[String, Function] (match functions by name)
+        angle_pairs : List[(Int, Int)] (pairs of angles in degrees. Must be divisible by 5)
+        object_types : List[String] (the objects pictured on the turntable)
+        thresholds : List[Float] (list of ratio thresholds)
+        ground_truth_data : Dict[(Int, Int), Dict[String, ground_truth]] (ground truth per angle pair and object)
+        options : Dict (Set of parameters for matching etc) and:
+            evaluate_workers : Int (Number of processes)
+            results_path : String (File every result is appended to as a json line.
+                           Results already in the file are not computed again)
+        Returns a list of result records, one per (matcher, object, angles, lighting).
+        Records are stored with a fingerprint of the options and of the ground
+        truth, so results of other options in the same file aren't reused. With
+        a results_path, cells that fail are returned as records with an "error"
+        and are left out of the file (without one the first failure is raised)
+    """
+
+    # Get options
+    workers             = options.get("evaluate_workers", 1)
+    results_path        = options.get("results_path", None)
+    verbose             = options.get("evaluate_verbose", False)
+    calibration_path    = options.get("calibration_cache", None)
+
+    # Find the cells that aren't done yet
+    fingerprint = options_fingerprint(options)
+    cells = [(name, object_type, tuple(angles), i)
+             for name in sorted(matchers)
+             for angles in angle_pairs
+             for object_type in object_types
+             for i in range(3)]
+    keys = set([result_key(cell_record(cell, thresholds, fingerprint, ground_truth_data)) for cell in cells])
+    records = unique_records([r for r in load_results(results_path) if result_key(r) in keys]) if results_path != None else []
+    done = set([result_key(r) for r in records])
+    tasks = [cell for cell in cells if not result_key(cell_record(cell, thresholds, fingerprint, ground_truth_data)) in done]
+    if verbose : print("Running %i experiments, %i already done" % (len(tasks), len(records)))
+
+    # Load calibration before forking so every process shares it
+    if calibration_path != None : load_calibration(calibration_path)
+    shared_experiment.update({
+        "matchers" : matchers,
+        "thresholds" : thresholds,
+        "ground_truth_data" : ground_truth_data,
+        "options" : options,
+        "fingerprint" : fingerprint,
+    })
+
+    def collect(results) :
+        out = open(results_path, "a+") if results_path != None else None
+        try :
+            # End a line cut off by an interruption so the next record starts on its own line
+            if out != None and os.path.getsize(results_path) > 0 :
+                out.seek(-1, os.SEEK_END)
+                ended = out.read(1) == "\n"
+                out.seek(0, os.SEEK_END)
+                if not ended : out.write("\n")
+            for record in results :
+                # Failed cells are left out of the results file, so they are run again on resume
+                if "error" in record :
+                    if out == None : raise Exception(record["error"])
+                    print("Experiment %s failed: %s" % (str(result_key(record)[:4]), record["error"]))
+                    records.append(record)
+                    continue
+                records.append(record)
+                if out != None :
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+        finally :
+            if out != None : out.close()
+
+    try :
+        if workers > 1 and len(tasks) > 1 :
+            pool = multiprocessing.Pool(workers)
+            try :
+                collect(pool.imap_unordered(run_experiment, tasks))
+            finally :
+                pool.close()
+                pool.join()
+        else :
+            collect(run_experiment(t) for t in tasks)
+    finally :
+        shared_experiment.clear()
+
+    return records
+
+
+
+def run_experiment(task) :
+    """ Evaluates one (matcher, object, angles, lighting) task using shared_experiment """
+    name, object_type, angles, i = task
+    thresholds = shared_experiment["thresholds"]
+    ground_truth_data = shared_experiment["ground_truth_data"]
+    gt = None if ground_truth_data == None else ground_truth_data[angles][object_type]
+    record = cell_record(task, thresholds, shared_experiment["fingerprint"], ground_truth_data)
+    try :
+        options = dict(shared_experiment["options"])
+        record.update(evaluate_lighting(shared_experiment["matchers"][name], angles, object_type, i, thresholds, gt, options))
+    except Exception as e :
+        record["error"] = str(e)
+    return record
+
+
+
+def cell_record(cell, thresholds, fingerprint, ground_truth_data = None) :
+    """ Returns the record of a (matcher, object, angles, lighting) cell without results """
+    name, object_type, angles, i = cell
+    return { "matcher" : name, "object_type" : object_type, "angles" : list(angles), "lighting" : i,
+             "thresholds" : list(thresholds), "options" : fingerprint,
+             "ground_truth" : ground_truth_fingerprint(ground_truth_data, cell) }
+
+
+
+def result_key(record) :
+    return (record["matcher"], record["object_type"], tuple(record["angles"]), record["lighting"],
+            tuple(record["thresholds"]), record.get("options", None), record.get("ground_truth", None))
+
+
+
+def unique_records(records) :
+    """ Keeps the first record of every result_key """
+    seen = set([])
+    unique = []
+    for r in records :
+        key = result_key(r)
+        if not key in seen :
+            seen.add(key)
+            unique.append(r)
+    return unique
+
+
+
+# Options that only change how experiments are run and not their results
+runner_option_keys = ["evaluate_workers", "results_path", "evaluate_verbose", "verbose", "feature_verbose", "calibration_cache",
+                      "feature_cache", "feature_store", "feature_workers", "feature_chunksize", "filter_features"]
+
+def options_fingerprint(options) :
+    """ Returns a hash of the options that can change the results of an experiment.
+        Functions are represented by their name, so they are the same between runs
+    """
+    relevant = { k : v for k, v in options.iteritems() if not k in runner_option_keys }
+    return hash_value(relevant)
+
+
+
+def ground_truth_fingerprint(ground_truth_data, cell) :
+    """ Returns a hash of the features filtered by ground truth in a cell, or
+        None if no ground truth is used
+    """
+    name, object_type, angles, i = cell
+    if ground_truth_data == None : return None
+    return hash_value(ground_truth_data[tuple(angles)][object_type]["filter_features"][i])
+
+
+
+def hash_value(value) :
+    """ Returns a short sha1 hash of the json encoding of value """
+    def encode(v) :
+        if isinstance(v, numpy.generic) : return v.item()
+        if isinstance(v, numpy.ndarray) : return v.tolist()
+        if callable(v) : return getattr(v, "__name__", type(v).__name__)
+        return repr(v)
+    return hashlib.sha1(json.dumps(value, sort_keys = True, default = encode)).hexdigest()[:16]
+
+
+
+def load_results(results_path) :
+    """ Returns the records in a results file. A line cut off by an interruption is ignored """
+    if not os.path.exists(results_path) : return []
+    records = []
+    with open(results_path) as f :
+        for line in f :
+            try :
+                records.append(json.loads(line))
+            except ValueError :
+                pass
+    return records
+
+
+
+def collect_results(records, object_types = None, thresholds = None, options = None, use_ground_truth = None) :
+    """ Sums the results of the lighting conditions and returns the number of
+        correct and total matches per matcher and angle pair in the format of
+        evaluate_objects: { matcher : { angles : { "correct" : { object_type : [...] }, "total" : ... } } }
+        Only records of the given thresholds (and options, and with or without
+        ground truth) are used, failed cells are skipped and every cell is counted once
+    """
+    options_hash = None if options == None else options_fingerprint(options)
+    results = {}
+    for r in unique_records([r for r in records if not "error" in r]) :
+        if options_hash != None and r.get("options", None) != options_hash : continue
+        if use_ground_truth != None and (r.get("ground_truth", None) != None) != use_ground_truth : continue
+        if object_types != None and not r["object_type"] in object_types : continue
+        if thresholds != None and list(r["thresholds"]) != list(thresholds) : continue
+        cell = results.setdefault(r["matcher"], {}).setdefault(tuple(r["angles"]), { "correct" : {}, "total" : {} })
+        for key in ["correct", "total"] :
+            counts = cell[key].get(r["object_type"], [0] * len(r[key]))
+            cell[key][r["object_type"]] = [a + b for a, b in zip(counts, r[key])]
+    return results
 
 
 
@@ -146,6 +424,23 @@ def load_calibration_image(object_type, angle, camera_position, pattern_position
 def get_calibration_points(object_type, angle, camera_position, pattern_position) :
     """ Returns the calibration points from an image with the checkerboard pattern """
 
+    # Look up points in cache
+    key = (get_image_set(object_type), angle, camera_position, pattern_position)
+    if key in calibration_cache["points"] :
+        points = calibration_cache["points"][key]
+    else :
+        points = find_calibration_points(object_type, angle, camera_position, pattern_position)
+        calibration_cache["points"][key] = points
+
+    if points is None :
+        raise Exception("Can't get lock on chess pattern: Angle: %i, object: %s, camera position: %s, pattern_position: %s" % (angle, object_type, camera_position, pattern_position))
+    return points
+
+
+
+def find_calibration_points(object_type, angle, camera_position, pattern_position) :
+    """ Finds the checkerboard corners in a calibration image. Returns None if there are none """
+
     # Load img
     img = load_calibration_image(object_type, angle, camera_position, pattern_position)
     
@@ -155,10 +450,8 @@ def get_calibration_points(object_type, angle, camera_position, pattern_position
         grid_size = (13, 9)
     success, cv_points = cv2.findChessboardCorners(img, grid_size, flags = cv2.CALIB_CB_FILTER_QUADS)
     if not success :
-        raise Exception("Can't get lock on chess pattern: Angle: %i, object: %s, camera position: %s, pattern_position: %s" % (angle, object_type, camera_position, pattern_position))
-    points = numpy.array([[p[0][0], p[0][1]] for p in cv_points])
-    #print(points)
-    return points# Get calibration points
+        return None
+    return numpy.array([[p[0][0], p[0][1]] for p in cv_points])
 
 
 
@@ -173,21 +466,30 @@ def get_foundamental_matrix(object_type, angles, camera_position, scale = 2.0, r
     # Get image set:
     image_set = get_image_set(object_type)
 
+    # Look up matrix in cache
+    key = (image_set, tuple(angles), tuple(camera_position), scale)
+    if key in calibration_cache["F"] and not return_points :
+        return calibration_cache["F"][key]
 
     # Fetch all images for the angle pair
     points1_flat = get_calibration_points(object_type, angles[0], camera_position[0], "flat")
     points2_flat = get_calibration_points(object_type, angles[1], camera_position[1], "flat")
-    points1_angled = get_calibration_points(object_type, angles[0], camera_position[0], "angled")
-    points2_angled = get_calibration_points(object_type, angles[1], camera_position[1], "angled")
-    points1_steep = get_calibration_points(object_type, angles[0], camera_position[0], "steep")
-    points2_steep = get_calibration_points(object_type, angles[1], camera_position[1], "steep")
-    
-    # Concatenate point sets
-    points1 = numpy.concatenate((points1_flat, points1_angled, points1_steep)) / scale
-    points2 = numpy.concatenate((points2_flat, points2_angled, points2_steep)) / scale
-    
-    # Find fundamental matrix based on points
-    F, inliers = cv2.findFundamentalMat(points1, points2, method = cv2.FM_RANSAC)
+
+    if key in calibration_cache["F"] :
+        F = calibration_cache["F"][key]
+    else :
+        points1_angled = get_calibration_points(object_type, angles[0], camera_position[0], "angled")
+        points2_angled = get_calibration_points(object_type, angles[1], camera_position[1], "angled")
+        points1_steep = get_calibration_points(object_type, angles[0], camera_position[0], "steep")
+        points2_steep = get_calibration_points(object_type, angles[1], camera_position[1], "steep")
+        
+        # Concatenate point sets
+        points1 = numpy.concatenate((points1_flat, points1_angled, points1_steep)) / scale
+        points2 = numpy.concatenate((points2_flat, points2_angled, points2_steep)) / scale
+        
+        # Find fundamental matrix based on points
+        F, inliers = cv2.findFundamentalMat(points1, points2, method = cv2.FM_RANSAC)
+        calibration_cache["F"][key] = F
     
     # return matrix with or without points
     if return_points :
@@ -197,6 +499,60 @@ def get_foundamental_matrix(object_type, angles, camera_position, scale = 2.0, r
 
 
 
+def precompute_calibration(object_types, angle_pairs, cache_path = None, scale = 2.0, verbose = False) :
+    """ Computes the calibration points and the fundamental matrices used by
+        match_distances and calc_ground_truth for all objects and angle pairs:
+        object_types : List[String] (objects pictured on the turntable, one per image set is enough)
+        angle_pairs : List[(Int, Int)] (pairs of angles in degrees. Must be divisible by 5)
+        cache_path : String (file the cache is saved to afterwards)
+    """
+    image_sets = {}
+    for object_type in object_types :
+        image_sets.setdefault(get_image_set(object_type), object_type)
+
+    for image_set, object_type in sorted(image_sets.items()) :
+        for angles in angle_pairs :
+            for view_angles, camera_position in view_pairs(angles) :
+                try :
+                    get_foundamental_matrix(object_type, view_angles, camera_position, scale = scale)
+                except Exception as e :
+                    if verbose : print(e)
+        if verbose : print("Calibrated image set %i" % image_set)
+
+    if cache_path != None : save_calibration(cache_path)
+
+
+
+def view_pairs(angles) :
+    """ Returns the angles and camera positions of the reference, test and auxiliary view """
+    return [((angles[0], angles[1]), ("Bottom", "Bottom")),
+            ((angles[0], angles[0]), ("Bottom", "Top")),
+            ((angles[0], angles[1]), ("Top", "Bottom"))]
+
+
+
+def save_calibration(cache_path) :
+    """ Saves the calibration cache in one file. The file is written under a
+        temporary name first so a concurrent reader never sees half a file
+    """
+    tmp_path = "%s.%i.tmp" % (cache_path, os.getpid())
+    with open(tmp_path, "wb") as f :
+        cPickle.dump({ "points" : calibration_cache["points"], "F" : calibration_cache["F"] }, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, cache_path)
+
+
+
+def load_calibration(cache_path) :
+    """ Loads a calibration cache saved by save_calibration. Each file is only read once """
+    if cache_path in calibration_cache["loaded"] or not os.path.exists(cache_path) : return
+    with open(cache_path, "rb") as f :
+        data = cPickle.load(f)
+    calibration_cache["points"].update(data["points"])
+    calibration_cache["F"].update(data["F"])
+    calibration_cache["loaded"].add(cache_path)
+
+
+
 def epilines(img, points, lines, size = (12, 12)) :
     """ Draws a set of epilines and points on an image """
     # Generate figure
@@ -227,17 +583,18 @@ def epilines(img, points, lines, size = (12, 12)) :
 
 
 
-def match_distances(matches, angles, object_type, check_threshold) :
+def match_distances(matches, angles, object_type, check_threshold, lightning_index = 0, options = {}) :
     """ Find the distance of matches as measured against two intersection epipolar lines:
         matches : List[(Pos,Pos)] (List of corresponding coordinates in two images)
         angles : (Int, Int) (two angles in degrees. Must be divisible by 5)
         object_type : String (The type of 3d model we are looking at)
         check_threshold : Float (The threshold for a correct correspondence)
+        lightning_index : Int (0, 1 or 2)
+        options : Dict (Feature options. The features of B are the ones used for the ground truth)
     """
     
     # Get features in B
-    path_B = get_turntable_path(object_type, angles[0], "Top")
-    img_B = features.loadImage(path_B)
+    keypoints_B = keypoints(object_type, angles[0] + 360*lightning_index, "Top", options)
     
     # Find fundamental matrices
     F_AC = get_foundamental_matrix(object_type, (angles[0], angles[1]), ("Bottom", "Bottom"), scale = 2.0) # Reference view
@@ -245,49 +602,40 @@ def match_distances(matches, angles, object_type, check_threshold) :
     F_BC = get_foundamental_matrix(object_type, (angles[0], angles[1]), ("Top", "Bottom"), scale = 2.0) # Auxiliary view
     
     # return distances
-    return list(calc_match_distances(matches, img_B, F_AB, F_AC, F_BC, check_threshold))
+    return list(calc_match_distances(matches, keypoints_B, F_AB, F_AC, F_BC, check_threshold))
 
 
 
-def calc_match_distances(matches, img_B, F_AB, F_AC, F_BC, check_threshold) :
+def calc_match_distances(matches, keypoints_B, F_AB, F_AC, F_BC, check_threshold) :
     """ Helper function for match_distances()
-        Check ground truth for a set of matches given fundamental matrices,
+        Check ground truth for a set of matches given fundamental matrices and
+        the positions of the features in B,
         As proposed in: "Evaluation of Features Detectors and Descriptors 
         based on 3D objects by Pierre Moreels and Peitro Perona.
     """
     
-    # Calculate distance between line and 2D-point
-    def dist(line, point) :
-        return numpy.abs(line.dot([point[0], point[1], 1]))
-    
-    # return epipolar line
-    def get_lines(points, F) :
-        return [l[0] for l in cv2.computeCorrespondEpilines(points.reshape(-1, 1, 2), 1, F)]
-    
     # Find points that are on l_AB
-    points_A = numpy.array([m[0] for m in matches], dtype=numpy.float32)
-    points_C = numpy.array([m[1] for m in matches], dtype=numpy.float32)
+    points_A = numpy.array([m[0] for m in matches], dtype=numpy.float32).reshape(-1, 2)
+    points_C = numpy.array([m[1] for m in matches], dtype=numpy.float32).reshape(-1, 2)
     lines_AB = get_lines(points_A, F_AB)
     lines_AC = get_lines(points_A, F_AC)
     
     # Collect features from B, so we can check the match there
-    feature_pos_B = features.getPositions(features.getKeypoints(img_B))
+    feature_pos_B = numpy.asarray(keypoints_B, dtype=numpy.float32).reshape(-1, 2)
+
+    # Is p_C on l_AC?
+    min_dist = numpy.abs((lines_AC * homogeneous(points_C)).sum(axis=1))
+
+    # Features in B that are on l_AB for every match (matches x B)
+    on_AB = line_distances(lines_AB, feature_pos_B) < check_threshold
+
+    # Distance from p_C to the closest line l_BC of a feature in B on l_AB
+    dist_BC = line_distances(get_lines(feature_pos_B, F_BC), points_C).T
+    min_BC = numpy.where(on_AB, dist_BC, numpy.inf).min(axis=1) if len(feature_pos_B) > 0 else numpy.inf
+
+    check = (min_dist < check_threshold) & on_AB.any(axis=1)
+    return numpy.where(check, numpy.maximum(min_BC, min_dist), min_dist)
 
-    for p_A, p_C, l_AB, l_AC in zip(points_A, points_C, lines_AB, lines_AC) :
-        
-        # Is p_C on l_AC?
-        min_dist = dist(l_AC, p_C)
-        if min_dist < check_threshold :
-            
-            # Collect all features in B that are on l_AB:
-            points_B = numpy.array([p_B for p_B in feature_pos_B if dist(l_AB, p_B) < check_threshold], dtype=numpy.float32)
-            
-            # Check if points match up
-            if len(points_B) > 0 :
-                lines_BC = get_lines(points_B, F_BC)
-                min_dist = max((numpy.min([dist(l_BC, p_C) for l_BC in lines_BC]), min_dist))
-                
-        yield min_dist
 
 
 def get_image_set(object_type) :
@@ -324,6 +672,8 @@ def ground_truth(angles, object_type, options = {}) :
         options : Dict (Set of parameters for matching etc)
     """
     verbose = options.get("evaluate_verbose", False)
+    calibration_path = options.get("calibration_cache", None)
+    if calibration_path != None : load_calibration(calibration_path)
     nb_correspondences = 0
     filter_features = []
     for i in range(3) :
@@ -339,20 +689,37 @@ def ground_truth(angles, object_type, options = {}) :
     return { "nb_correspondences" : nb_correspondences, "filter_features" : filter_features }
 
 
-# Load keypoints
-def keypoints(object_type, angle, viewpoint) :
+# Load keypoints and descriptors of one view. They are extracted once per
+# feature configuration and kept in options["feature_store"] (view_store by default)
+def view_features(object_type, angle, viewpoint, options = {}) :
     path = get_turntable_path(object_type, angle, viewpoint)
-    points = features.getPositions(features.getFeatures([path])[1])
-    return numpy.array(points, dtype=numpy.float32)
+    feature_options = dict(options, shuffle = False)
+    feature_options.setdefault("feature_store", view_store)
+    return features.getImageFeatures(path, feature_options)
+
+# Load keypoints
+def keypoints(object_type, angle, viewpoint, options = {}) :
+    points, descriptors = view_features(object_type, angle, viewpoint, options)
+    if descriptors is None : return numpy.zeros((0, 2), dtype=numpy.float32)
+    return numpy.array(features.getPositions(points), dtype=numpy.float32).reshape(-1, 2)
 
-# return epipolar line
+# return epipolar lines as an n x 3 array
 def get_lines(points, F) :
-    return [l[0] for l in cv2.computeCorrespondEpilines(points.reshape(-1, 1, 2), 1, F)]
+    if len(points) == 0 : return numpy.zeros((0, 3))
+    return cv2.computeCorrespondEpilines(points.reshape(-1, 1, 2), 1, F).reshape(-1, 3).astype(numpy.float64)
+
+# Append a column of ones to an n x 2 array of points
+def homogeneous(points) :
+    return numpy.hstack((numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2), numpy.ones((len(points), 1))))
 
 # Calculate distance between line and 2D-point
 def dist(line, point) :
     return numpy.abs(line.dot([point[0], point[1], 1]))
 
+# Calculate distance between every line and every 2D-point (lines x points)
+def line_distances(lines, points) :
+    return numpy.abs(numpy.asarray(lines, dtype=numpy.float64).reshape(-1, 3).dot(homogeneous(points).T))
+
 
 
 def calc_ground_truth(angles, object_type, lightning_index = 0, return_matches = False, options = {}) :
@@ -370,9 +737,9 @@ def calc_ground_truth(angles, object_type, lightning_index = 0, return_matches =
     verbose             = options.get("verbose", False)
 
     # Get paths to the three images
-    keypoints_A = keypoints(object_type, angles[0]+360*lightning_index, "Bottom")
-    keypoints_B = keypoints(object_type, angles[0]+360*lightning_index, "Top")
-    keypoints_C = keypoints(object_type, angles[1]+360*lightning_index, "Bottom")
+    keypoints_A = keypoints(object_type, angles[0]+360*lightning_index, "Bottom", options)
+    keypoints_B = keypoints(object_type, angles[0]+360*lightning_index, "Top", options)
+    keypoints_C = keypoints(object_type, angles[1]+360*lightning_index, "Bottom", options)
 
     # Find fundamental matrices
     F_AC = get_foundamental_matrix(object_type, (angles[0], angles[1]), ("Bottom", "Bottom"), scale = 2.0)
@@ -383,22 +750,21 @@ def calc_ground_truth(angles, object_type, lightning_index = 0, return_matches =
     lines_AB = get_lines(keypoints_A, F_AB)
     lines_AC = get_lines(keypoints_A, F_AC)
 
-    # For every epiline in B and C corresponding to a point in A
-    for i, (p_A, l_AB, l_AC) in enumerate(zip(keypoints_A, lines_AB, lines_AC)) :
-
-        # Find all points on the line in B and C
-        points_B = numpy.array([p_B for p_B in keypoints_B if dist(l_AB, p_B) < distance_threshold], dtype=numpy.float32)
-        points_C = numpy.array([p_C for p_C in keypoints_C if dist(l_AC, p_C) < distance_threshold], dtype=numpy.float32)
+    # Points in B and C on the epilines of every point in A (A x B and A x C)
+    on_AB = line_distances(lines_AB, keypoints_B) < distance_threshold
+    on_AC = line_distances(lines_AC, keypoints_C) < distance_threshold
 
-        # For every point in B on l_AB, see if there is a point in C on l_AC that lies on the epipolar line of p_B in image C: l_BC
-        if len(points_B) > 0 and len(points_C) > 0 :
+    # Points in C on the epiline of every point in B (B x C)
+    on_BC = line_distances(get_lines(keypoints_B, F_BC), keypoints_C) < distance_threshold
 
-            # Get distances from every point in C on line l_AC to every line in C corresponding to a point in B on line l_AB
-            get_distances = lambda line : [(dist(line, p_C), p_C) for p_C in points_C]
-            distances = features.flatten([get_distances(l_BC) for l_BC in get_lines(points_B, F_BC)])
+    # Number of points in B on l_AB whose line l_BC passes a point in C on l_AC (A x C)
+    counts = on_AB.astype(numpy.int32).dot(on_BC.astype(numpy.int32)) * on_AC
 
-            # Count how many potential matches there are
-            yield [(p_A, p_C) for d, p_C in distances if d < distance_threshold]
-
-        else :
+    # For every point in B on l_AB, see if there is a point in C on l_AC that lies on the epipolar line of p_B in image C: l_BC
+    for i, p_A in enumerate(keypoints_A) :
+        if not counts[i].any() :
             yield []
+        else :
+            index_B, index_C = numpy.nonzero(on_AB[i])[0], numpy.nonzero(on_AC[i])[0]
+            rows, cols = numpy.nonzero(on_BC[numpy.ix_(index_B, index_C)])
+            yield [(p_A, keypoints_C[index_C[c]]) for c in cols]
@@ -0,0 +1,207 @@
+"""
+Python module for geometric verification of matches with RANSAC. The matches
+of any matcher can be filtered to the ones that are consistent with a single
+homography or fundamental matrix, and the number of inliers can be used to
+rank image pairs. Hypotheses are fitted and scored in batches, and the number
+of iterations adapts to the inlier ratio found so far.
+
+Based on:
+@article{fischler1981random,
+  title={Random sample consensus: a paradigm for model fitting with applications to image analysis and automated cartography},
+  author={Fischler, Martin A and Bolles, Robert C},
+  journal={Communications of the ACM},
+  volume={24},
+  number={6},
+  pages={381--395},
+  year={1981},
+  publisher={ACM}
+}
+"""
+
+####################################
+#                                  #
+#            Imports               #
+#                                  #
+####################################
+
+import numpy
+
+
+####################################
+#                                  #
+#           Functions              #
+#                                  #
+####################################
+
+
+def verify(matches, options = {}) :
+    """ Finds the model most consistent with the matches using RANSAC
+        matches : numpy.ndarray (n x 2 x 2 positions, like the first column of a match_fun result)
+        options : verification_model ("homography" or "fundamental"), ransac_threshold
+                  (max error in pixels for an inlier), ransac_confidence,
+                  ransac_max_iterations, ransac_batch (hypotheses per batch), ransac_seed
+        Returns the inlier mask and the model (None if there are too few matches)
+    """
+
+    # Get options
+    model_type          = options.get("verification_model", "homography")
+    threshold           = options.get("ransac_threshold", 3.0)
+    confidence          = options.get("ransac_confidence", 0.99)
+    max_iterations      = options.get("ransac_max_iterations", 2000)
+    batch_size          = options.get("ransac_batch", 64)
+    seed                = options.get("ransac_seed", None)
+
+    fit, error, sample_size = model_map[model_type]
+    matches = numpy.asarray(matches, dtype=numpy.float64).reshape(-1, 2, 2)
+    n = len(matches)
+    if n < sample_size : return numpy.zeros(n, dtype=bool), None
+
+    # Normalize points so the fit is well conditioned
+    p_1, T_1 = normalize(matches[:, 0])
+    p_2, T_2 = normalize(matches[:, 1])
+    scale = T_2[0, 0]
+
+    random = numpy.random.RandomState(seed)
+    best_model, best_inliers, best_count = None, numpy.zeros(n, dtype=bool), 0
+    iterations, needed = 0, max_iterations
+    while iterations < min(needed, max_iterations) :
+
+        # Fit and score a batch of hypotheses
+        samples = numpy.array([random.choice(n, sample_size, replace = False) for i in range(batch_size)])
+        models = fit(p_1[samples], p_2[samples])
+        inliers = error(models, p_1, p_2) < threshold * scale
+        counts = inliers.sum(axis = 1)
+        iterations += batch_size
+
+        # Keep the best hypothesis and update how many iterations we need
+        best = numpy.argmax(counts)
+        if counts[best] > best_count :
+            best_model, best_inliers, best_count = models[best:best+1], inliers[best], counts[best]
+            needed = adaptiveIterations(best_count / float(n), sample_size, confidence)
+
+    if best_count < sample_size : return numpy.zeros(n, dtype=bool), None
+
+    # Refit on all inliers and keep the refit if it isn't worse
+    model = fit(p_1[best_inliers][numpy.newaxis], p_2[best_inliers][numpy.newaxis])
+    inliers = (error(model, p_1, p_2) < threshold * scale)[0]
+    if inliers.sum() < best_count : inliers, model = best_inliers, best_model
+
+    # Undo the normalization
+    return inliers, denormalize(model[0], T_1, T_2, model_type)
+
+
+
+def filter_matches(match_fun, options = {}) :
+    """ Wraps a match function so the matches returned for a threshold are
+        only the inliers of verify(). The first column must be the positions
+    """
+    def verified(threshold) :
+        columns = match_fun(threshold)
+        if len(columns[0]) == 0 : return columns
+        inliers, model = verify(columns[0], options)
+        return tuple(numpy.asarray(c)[inliers] for c in columns)
+
+    return verified
+
+
+
+def inlier_count(matches, options = {}) :
+    """ Returns the number of matches consistent with one model, for ranking image pairs """
+    inliers, model = verify(matches, options)
+    return int(numpy.sum(inliers))
+
+
+
+def adaptiveIterations(inlier_ratio, sample_size, confidence) :
+    """ Number of iterations needed to draw an all inlier sample with the given confidence """
+    p_good = inlier_ratio ** sample_size
+    if p_good >= 1 : return 0
+    if p_good <= 0 : return numpy.inf
+    return int(numpy.ceil(numpy.log(1 - confidence) / numpy.log(1 - p_good)))
+
+
+
+def normalize(points) :
+    """ Translates and scales points to mean 0 and mean distance sqrt(2) from the origin """
+    center = numpy.mean(points, axis = 0)
+    mean_dist = numpy.mean(numpy.sqrt(((points - center)**2).sum(axis = 1)))
+    s = numpy.sqrt(2) / mean_dist if mean_dist > 0 else 1.0
+    T = numpy.array([[s, 0, -s*center[0]], [0, s, -s*center[1]], [0, 0, 1]])
+    return (points - center) * s, T
+
+
+
+def denormalize(model, T_1, T_2, model_type) :
+    if model_type == "homography" :
+        H = numpy.linalg.inv(T_2).dot(model).dot(T_1)
+        return H / H[2, 2] if H[2, 2] != 0 else H
+    else :
+        F = T_2.T.dot(model).dot(T_1)
+        return F / numpy.linalg.norm(F)
+
+
+
+def homogeneous(points) :
+    return numpy.concatenate((points, numpy.ones(points.shape[:-1] + (1,))), axis = -1)
+
+
+
+def fitHomography(p_1, p_2) :
+    """ Fits a homography to each set of points (batch x n x 2) with the DLT """
+    x, y = p_1[..., 0], p_1[..., 1]
+    u, v = p_2[..., 0], p_2[..., 1]
+    zeros, ones = numpy.zeros(x.shape), numpy.ones(x.shape)
+    rows_1 = numpy.stack((-x, -y, -ones, zeros, zeros, zeros, u*x, u*y, u), axis = -1)
+    rows_2 = numpy.stack((zeros, zeros, zeros, -x, -y, -ones, v*x, v*y, v), axis = -1)
+    A = numpy.concatenate((rows_1, rows_2), axis = 1)
+    return nullVector(A).reshape(-1, 3, 3)
+
+
+
+def homographyError(H, p_1, p_2) :
+    """ Transfer error of every point pair for every homography (batch x n) """
+    projected = numpy.einsum("bij,nj->bni", H, homogeneous(p_1))
+    w = projected[..., 2]
+    w[numpy.abs(w) < 1e-12] = 1e-12
+    return numpy.sqrt(((projected[..., :2] / w[..., numpy.newaxis] - p_2)**2).sum(axis = 2))
+
+
+
+def fitFundamental(p_1, p_2) :
+    """ Fits a fundamental matrix of rank 2 to each set of points (batch x n x 2) with the 8 point algorithm """
+    x_1, x_2 = homogeneous(p_1), homogeneous(p_2)
+    A = (x_2[..., :, numpy.newaxis] * x_1[..., numpy.newaxis, :]).reshape(x_1.shape[:-1] + (9,))
+    F = nullVector(A).reshape(-1, 3, 3)
+
+    # Enforce rank 2
+    U, S, V = numpy.linalg.svd(F)
+    S[:, 2] = 0
+    return numpy.einsum("bij,bj,bjk->bik", U, S, V)
+
+
+
+def fundamentalError(F, p_1, p_2) :
+    """ Sampson distance of every point pair for every fundamental matrix (batch x n) """
+    x_1, x_2 = homogeneous(p_1), homogeneous(p_2)
+    Fx_1 = numpy.einsum("bij,nj->bni", F, x_1)
+    Ftx_2 = numpy.einsum("bji,nj->bni", F, x_2)
+    x_2Fx_1 = (Fx_1 * x_2[numpy.newaxis]).sum(axis = 2)
+    denominator = Fx_1[..., 0]**2 + Fx_1[..., 1]**2 + Ftx_2[..., 0]**2 + Ftx_2[..., 1]**2
+    return numpy.abs(x_2Fx_1) / numpy.sqrt(numpy.maximum(denominator, 1e-12))
+
+
+
+def nullVector(A) :
+    """ The right singular vector of the smallest singular value of each matrix in A """
+    if A.shape[1] < A.shape[2] :
+        A = numpy.concatenate((A, numpy.zeros((A.shape[0], A.shape[2] - A.shape[1], A.shape[2]))), axis = 1)
+    U, S, V = numpy.linalg.svd(A)
+    return V[:, -1, :]
+
+
+
+# Fit function, error function and sample size for each model
+model_map = {
+    "homography"    : (fitHomography, homographyError, 4),
+    "fundamental"   : (fitFundamental, fundamentalError, 8),
+}
@@ -0,0 +1,150 @@
+"""
+Python module for retrieving candidate image pairs with a bag of visual
+words. Descriptors are quantised to the nearest word of a vocabulary trained
+with k-means, and the images are indexed in an inverted file (a sparse
+word x image matrix) with tf-idf weights. Only the images most similar to a
+query need to be matched pairwise afterwards.
+
+Based on:
+@inproceedings{sivic2003video,
+  title={Video Google: A text retrieval approach to object matching in videos},
+  author={Sivic, Josef and Zisserman, Andrew},
+  booktitle={Computer Vision, 2003. Proceedings. Ninth IEEE International Conference on},
+  pages={1470--1477},
+  year={2003},
+  organization={IEEE}
+}
+"""
+
+####################################
+#                                  #
+#            Imports               #
+#                                  #
+####################################
+
+import features
+import trees
+import numpy
+import scipy.sparse
+from scipy.cluster.vq import kmeans2
+
+
+####################################
+#                                  #
+#           Functions              #
+#                                  #
+####################################
+
+
+def init(descriptor_sets, options = {}) :
+    """ Trains a vocabulary on a set of images and indexes them
+        descriptor_sets : List[numpy.ndarray] (the descriptors of every image, None if it has none)
+        Returns a function that given the descriptors of a query image and k
+        returns the indices and scores of the k most similar indexed images
+    """
+
+    # Get options
+    descriptor_type     = options.get("descriptor_type", "SIFT")
+    verbose             = options.get("verbose", False)
+
+    descriptor_sets = [d if d is not None else [] for d in descriptor_sets]
+    words = train(descriptor_sets, options)
+    quantize = quantizer(words, descriptor_type)
+    if verbose : print("Trained vocabulary of %i words" % len(words))
+
+    # Build the index
+    word_sets = [quantize(D) for D in descriptor_sets]
+    inverted, idf = index(word_sets, len(words))
+
+    def query(D, k) :
+        q = tfidf([quantize(D) if D is not None else []], len(words), idf)
+        scores = (q * inverted).toarray().ravel()
+        best = numpy.argsort(-scores, kind="mergesort")[:k]
+        return best, scores[best]
+
+    return query
+
+
+
+def candidates(descriptor_sets, k = 5, options = {}) :
+    """ Returns a sorted list of image pairs (i, j) with i < j where j is
+        among the k most similar images of i or the other way around
+    """
+    query = init(descriptor_sets, options)
+    pairs = set([])
+    for i, D in enumerate(descriptor_sets) :
+        best, scores = query(D, k + 1)
+        for j in best[scores > 0] :
+            if j != i : pairs.add((min(i, j), max(i, j)))
+    return sorted(pairs)
+
+
+
+def train(descriptor_sets, options = {}) :
+    """ Clusters a sample of the descriptors with k-means and returns the
+        cluster centers as words. Binary descriptors are clustered as bits
+        and the centers are rounded and packed again
+    """
+
+    # Get options
+    descriptor_type     = options.get("descriptor_type", "SIFT")
+    vocabulary_size     = options.get("vocabulary_size", 1000)
+    sample_size         = options.get("vocabulary_sample", 100000)
+    iterations          = options.get("vocabulary_iterations", 10)
+
+    D = numpy.concatenate([d for d in descriptor_sets if len(d) > 0])
+    if len(D) > sample_size :
+        D = D[numpy.random.permutation(len(D))[:sample_size]]
+
+    binary = features.dist_map(descriptor_type) == "hamming"
+    data = numpy.unpackbits(D.astype(numpy.uint8), axis=1) if binary else D
+    centers, labels = kmeans2(data.astype(numpy.float64), min(vocabulary_size, len(D)), iter = iterations, minit = "points")
+
+    # Drop empty clusters
+    centers = centers[numpy.unique(labels)]
+
+    if binary : return numpy.packbits(centers > 0.5, axis=1)
+    else : return centers.astype(D.dtype)
+
+
+
+def quantizer(words, descriptor_type = "SIFT") :
+    """ Returns a function mapping descriptors to the index of their nearest word """
+    tree_type = "hamming" if features.dist_map(descriptor_type) == "hamming" else "ball"
+    tree = trees.init(words, tree_type)
+
+    def quantize(D) :
+        if len(D) == 0 : return numpy.array([], dtype=numpy.int64)
+        return numpy.array([idx[0] for idx, dist in tree(D, 1)], dtype=numpy.int64)
+
+    return quantize
+
+
+
+def index(word_sets, nb_words) :
+    """ Returns the inverted file as a sparse matrix of size nb_words x
+        nb_images holding the normalized tf-idf vector of every image, and
+        the idf weight of every word
+    """
+    nb_images = len(word_sets)
+    df = numpy.zeros(nb_words)
+    for ws in word_sets :
+        df[numpy.unique(ws)] += 1
+    idf = numpy.log(nb_images / numpy.maximum(df, 1))
+    return tfidf(word_sets, nb_words, idf).T.tocsr(), idf
+
+
+
+def tfidf(word_sets, nb_words, idf) :
+    """ Returns a sparse matrix with a row per image holding its tf-idf
+        vector normalized to unit length
+    """
+    rows = numpy.concatenate([numpy.ones(len(ws), dtype=numpy.int64) * i for i, ws in enumerate(word_sets)])
+    cols = numpy.concatenate([numpy.asarray(ws, dtype=numpy.int64) for ws in word_sets])
+    tf = scipy.sparse.coo_matrix((numpy.ones(len(rows)), (rows, cols)), shape = (len(word_sets), nb_words)).tocsr()
+
+    # Weight the term frequencies by idf and normalize
+    sizes = numpy.maximum(numpy.array([len(ws) for ws in word_sets], dtype=numpy.float64), 1)
+    weighted = scipy.sparse.diags(1 / sizes, 0) * tf * scipy.sparse.diags(idf, 0)
+    norms = numpy.sqrt(numpy.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    return scipy.sparse.diags(1 / numpy.maximum(norms, 1e-12), 0) * weighted
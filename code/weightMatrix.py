@@ -12,8 +12,12 @@ Jonas Toft Arnfred, 2013-03-19
 ####################################
 
 import numpy
+import scipy.sparse
 import math
 import features
+import trees
+import louvain
+import time
 from itertools import dropwhile
 
 
@@ -30,17 +34,7 @@ def hammingDist(descriptors) :
 		output[0][1] is equal to the hamming distance between descriptors[0] and descriptors[1]
 		where output is the matrix returned from this function
 	"""
-	# rearrange inputs
-	binary = numpy.array(numpy.unpackbits(descriptors), dtype=numpy.bool)
-	binary.shape = (descriptors.shape[0], descriptors.shape[1] * 8)
-
-	# Initialize return matrix
-	result = numpy.zeros([descriptors.shape[0], descriptors.shape[0]], dtype=numpy.uint8)
-
-	# Fill result matrix and return
-	for (i, bin_row) in enumerate(binary) :
-		result[i] = numpy.sum(numpy.bitwise_xor(binary, bin_row), 1)
-	return result
+	return trees.hamming_dist(descriptors, descriptors)
 
 
 
@@ -54,26 +48,44 @@ def angleDist(D) :
 
 
 
-def init(descriptors, descriptor_type) :
+# Distance measure and maximum distance per descriptor type
+dist_fun_map = {
+	"SIFT"   : angleDist,
+	"SURF"   : angleDist,
+	"ORB"    : hammingDist,
+	"BRISK"  : hammingDist,
+	"BRIEF"  : hammingDist,
+	"FREAK"  : hammingDist
+}
+
+dist_max_map = {
+	"SIFT"   : numpy.pi,
+	"SURF"   : numpy.pi,
+	"ORB"    : 255,
+	"BRISK"  : 255,
+	"BRIEF"  : 255,
+	"FREAK"  : 255
+}
+
+
+
+def init(descriptors, descriptor_type, dtype = numpy.float64, block_size = None) :
+	""" Returns the n x n weight matrix of the descriptors where weights are
+		1 - the normalized distance and the diagonal is 0
+		Input: descriptors [numpy.ndarray] n descriptors
+			   descriptor_type [string] e.g "SIFT" or "ORB"
+			   dtype [numpy.dtype] type of the returned matrix. float32 halves the memory
+			   block_size [int] if set, the matrix is filled block_size rows at a time 
+			                    so no n x n temporaries are needed
+	"""
 
-	dist_fun_map = {
-		"SIFT"   : angleDist,
-		"SURF"   : angleDist,
-		"ORB"    : hammingDist,
-		"BRISK"  : hammingDist,
-		"BRIEF"  : hammingDist,
-		"FREAK"  : hammingDist
-	}
+	# Fill in matrix block by block
+	if block_size != None :
+		weights = numpy.empty((descriptors.shape[0], descriptors.shape[0]), dtype=dtype)
+		for i, block in getWeightBlocks(descriptors, descriptor_type, block_size) :
+			weights[i:i+block.shape[0]] = block
+		return weights
 
-	dist_max_map = {
-		"SIFT"   : numpy.pi,
-		"SURF"   : numpy.pi,
-		"ORB"    : 255,
-		"BRISK"  : 255,
-		"BRIEF"  : 255,
-		"FREAK"  : 255
-	}
-	
 	dist_measure = dist_fun_map.get(descriptor_type, hammingDist)
 	dist_max = dist_max_map.get(descriptor_type, 255.0)
 
@@ -91,14 +103,109 @@ def init(descriptors, descriptor_type) :
 	# Set the self-distances to 0
 	numpy.fill_diagonal(weights, 0)
 
-	return weights
+	return numpy.asarray(weights, dtype=dtype)
+
+
+
+def initPruned(descriptors, descriptor_type, edges_per_vertex, n=600, start=0.0, block_size=1000, dtype=numpy.float32, with_top=False) :
+	""" Returns the same edges as pruneThreshold(init(descriptors, descriptor_type), edges_per_vertex)
+		as a sparse matrix without ever holding the dense matrix in memory. The weights 
+		are computed twice block by block: once to find the treshold and once to 
+		collect the edges above it
+		Input: descriptors [numpy.ndarray] n descriptors
+			   descriptor_type [string] e.g "SIFT" or "ORB"
+			   edges_per_vertex [float] see pruneThreshold
+			   block_size [int] number of rows computed at a time
+			   dtype [numpy.dtype] type of the stored weights
+			   with_top [bool] also return the second largest and largest weight of
+			                   every row of the full matrix (n x 2), collected in the first pass
+		Out:   [scipy.sparse.csr_matrix] pruned weights
+	"""
+	nb_vertices = descriptors.shape[0]
+
+	# Count weights above each treshold in the same grid as get_treshold
+	tresholds = numpy.linspace(1,start,n)
+	counts = numpy.zeros(n, dtype=numpy.int64)
+	top = numpy.zeros((nb_vertices, 2))
+	for i, block in getWeightBlocks(descriptors, descriptor_type, block_size) :
+		counts += countAbove(block, tresholds)
+		if with_top and nb_vertices >= 2 :
+			top[i:i+block.shape[0]] = numpy.partition(block, [-2, -1], axis=1)[:, -2:]
+	w = counts / (2.0*nb_vertices)
+	treshold = tresholdFromCounts(w, tresholds, edges_per_vertex, n, start)
+
+	# Collect edges above treshold
+	rows, cols, data = [], [], []
+	for i, block in getWeightBlocks(descriptors, descriptor_type, block_size) :
+		r, c = numpy.nonzero((block > treshold) & (block != 1))
+		rows.append(r + i)
+		cols.append(c)
+		data.append(numpy.asarray(block[r, c], dtype=dtype))
+
+	rows, cols, data = (numpy.concatenate(rows), numpy.concatenate(cols), numpy.concatenate(data))
+	pruned = scipy.sparse.csr_matrix((data, (rows, cols)), shape=(nb_vertices, nb_vertices))
+	if with_top : return pruned, top
+	return pruned
+
+
+
+def getWeightBlocks(descriptors, descriptor_type, block_size) :
+	""" Yields (i, block) where block is rows i to i + block_size of the weight
+		matrix returned by init. For angle distances the normalization by the
+		largest dot product uses the largest self dot product, which is the same
+		up to rounding
+	"""
+	dist_max = dist_max_map.get(descriptor_type, 255.0)
+	nb_vertices = descriptors.shape[0]
+
+	if dist_fun_map.get(descriptor_type, hammingDist) == angleDist :
+		norms = numpy.array([numpy.linalg.norm(row) for row in descriptors])
+		D_n = descriptors / norms[:, numpy.newaxis]
+		max_dot = numpy.max(numpy.sum(D_n * D_n, axis=1))
+		def distances(i) : return numpy.arccos(numpy.minimum(D_n[i:i+block_size].dot(D_n.T) / max_dot, 1.0))
+	else :
+		def distances(i) : return trees.hamming_dist(descriptors[i:i+block_size], descriptors)
+
+	for i in range(0, nb_vertices, block_size) :
+		block = 1 - distances(i) / float(dist_max)
+		r = numpy.arange(block.shape[0])
+		block[r, r + i] = 0
+		yield i, block
 
 
 
 def get_treshold(weights, edges_per_vertex, n=600, start=0.0) :
 	nb_vertices = weights.shape[0]
 	tresholds = numpy.linspace(1,start,n)
-	w = [numpy.sum(weights > t) / (2.0*nb_vertices) for t in tresholds]
+	w = countAbove(weights, tresholds) / (2.0*nb_vertices)
+	return tresholdFromCounts(w, tresholds, edges_per_vertex, n, start)
+
+
+
+def countAbove(values, tresholds, chunk_size = 2**22) :
+	""" Returns the amount of values strictly above each treshold, the same as
+		[numpy.sum(values > t) for t in tresholds], where tresholds are sorted in
+		descending order. Every value is put in its bin of the treshold grid 
+		with a binary search, so values are only read once
+	"""
+	grid = tresholds[::-1]
+	bins = numpy.zeros(len(grid) + 1, dtype=numpy.int64)
+	flat = values.ravel()
+	for i in range(0, flat.size, chunk_size) :
+		chunk = flat[i:i+chunk_size]
+		chunk = chunk[~numpy.isnan(chunk)]
+		bins += numpy.bincount(numpy.searchsorted(grid, chunk, side='left'), minlength=len(grid)+1)
+
+	# A value is above grid[g] if more than g grid points are below it
+	above = numpy.cumsum(bins[::-1])[::-1][1:]
+	return above[::-1]
+
+
+
+def tresholdFromCounts(w, tresholds, edges_per_vertex, n, start) :
+	""" Given the edges per vertex w above each treshold, return the first 
+		treshold with at least edges_per_vertex edges per vertex
+	"""
 	q = dropwhile(lambda e : e < edges_per_vertex, w)
 	index = len(list(q))
 	if (index <= 0) : return start
@@ -111,7 +218,7 @@ def pruneRows(weights, fraction, n = 1000) :
 	def getTres() :
 		row_max = numpy.max(weights, axis=0)
 		tresholds = numpy.linspace(numpy.max(row_max),numpy.min(row_max),n)
-		w = [numpy.sum(row_max > t) / float(row_max.size) for t in tresholds]
+		w = countAbove(row_max, tresholds) / float(row_max.size)
 		q = dropwhile(lambda e : e < fraction, w)
 		index = len(list(q))
 		return tresholds[n-index]
@@ -129,7 +236,7 @@ def pruneRows(weights, fraction, n = 1000) :
 def get_fraction(weights, fraction, n=600, start=0.0) :
 	nb_weights = float(weights.size)
 	tresholds = numpy.linspace(1,start,n)
-	w = [numpy.sum(weights > t) / nb_weights for t in tresholds]
+	w = countAbove(weights, tresholds) / nb_weights
 	q = dropwhile(lambda e : e < fraction, w)
 	index = len(list(q))
 	if (index <= 0) : return start
@@ -196,3 +303,32 @@ def resultMatrix(paths, result) :
 	min_val = numpy.min(m)
 	ret = (m - min_val) / (max_val - min_val)
 	return ret
+
+
+
+def benchmark(weights, edges_per_vertex, prune_limit=1.5, n=600) :
+	""" Times finding the treshold of pruneThreshold by counting the weights 
+		above every treshold one at a time (as get_treshold used to) against
+		countAbove. Besides the full matrix this is done for every partition 
+		found by louvain, which is what clustermatch.cluster prunes when 
+		recursing. Returns both times and whether the tresholds are the same
+	"""
+	def loop_treshold(w, epv) :
+		tresholds = numpy.linspace(1,0.0,n)
+		counts = [numpy.sum(w > t) / (2.0*w.shape[0]) for t in tresholds]
+		return tresholdFromCounts(counts, tresholds, epv, n, 0.0)
+
+	# The full matrix and the partitions clustermatch.cluster would split
+	pruned = pruneThreshold(weights, edges_per_vertex, n=n)
+	partitions = louvain.cluster(pruned)
+	jobs = [(weights, edges_per_vertex)] + [(pruned[partitions == p][:, partitions == p], prune_limit) for p in set(partitions)]
+
+	start = time.time()
+	loop = [loop_treshold(w, epv) for w, epv in jobs]
+	time_loop = time.time() - start
+
+	start = time.time()
+	vectorized = [get_treshold(w, epv, n=n) for w, epv in jobs]
+	time_vectorized = time.time() - start
+
+	return { "loop" : time_loop, "vectorized" : time_vectorized, "same" : loop == vectorized }